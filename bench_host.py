@@ -0,0 +1,339 @@
+"""Load test for newhost.py against a local fake Telegram Bot API.
+
+Runs the host Application in-process, pointed at a fake Bot API served on
+localhost, and simulates concurrent users going through /new -> zip -> main
+file -> token, then /all and remove. Results are written as JSON so runs can be
+compared across commits:
+
+    python bench_host.py --users 20 --output bench.json
+
+Everything the host writes (scripts, envs, logs, registry) goes to a temporary
+directory that is removed afterwards.
+"""
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import asyncio
+import zipfile
+import argparse
+import tempfile
+import itertools
+import subprocess
+import statistics
+import urllib.parse
+
+import newhost
+
+FAKE_TOKEN = "123456:BENCH"
+HOST_BOT = {"id": 123456, "is_bot": True, "first_name": "Host", "username": "host_bench_bot"}
+REPLY_TIMEOUT = 120
+
+BOT_WITH_TOKEN = 'import time\nBOT_TOKEN = "0:fake"\nwhile True:\n    time.sleep(60)\n'
+BOT_WITHOUT_TOKEN = 'import time\nwhile True:\n    time.sleep(60)\n'
+
+class FakeBotAPI:
+    """Serves the subset of the Bot API the host uses and records what the bot sends.
+
+    Updates are injected with push_update(); every sendMessage/editMessageText is
+    delivered to the per-chat queue returned by replies().
+    """
+
+    def __init__(self):
+        self.updates = []
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.new_updates = asyncio.Event()
+        self.files = {}
+        self.chat_queues = {}
+        self.server = None
+        self.port = None
+        self.calls = {}
+        self.connections = set()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        for connection in self.connections:
+            connection.cancel()
+        await asyncio.gather(*self.connections, return_exceptions=True)
+        await self.server.wait_closed()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    @property
+    def base_file_url(self):
+        return f"http://127.0.0.1:{self.port}/file/bot"
+
+    def replies(self, chat_id):
+        return self.chat_queues.setdefault(chat_id, asyncio.Queue())
+
+    def push_update(self, update):
+        update["update_id"] = next(self.update_ids)
+        self.updates.append(update)
+        self.new_updates.set()
+
+    def add_file(self, file_id, data):
+        self.files[file_id] = data
+
+    def _message(self, chat_id, text, reply_markup=None):
+        message = {"message_id": next(self.message_ids), "date": int(time.time()),
+                   "chat": {"id": chat_id, "type": "private"}, "from": HOST_BOT, "text": text}
+        if reply_markup:
+            message["reply_markup"] = reply_markup
+        return message
+
+    async def _get_updates(self, params):
+        offset = int(params.get("offset", 0))
+        self.updates = [update for update in self.updates if update["update_id"] >= offset]
+        if not self.updates:
+            self.new_updates.clear()
+            try:
+                await asyncio.wait_for(self.new_updates.wait(), float(params.get("timeout", 0)) or 0.01)
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:int(params.get("limit", 100))]
+
+    async def _call(self, method, params):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if method == "getMe":
+            return HOST_BOT
+        if method == "getUpdates":
+            return await self._get_updates(params)
+        if method in ("deleteWebhook", "setWebhook", "answerCallbackQuery"):
+            return True
+        if method == "getFile":
+            file_id = params["file_id"]
+            return {"file_id": file_id, "file_unique_id": file_id, "file_size": len(self.files[file_id]),
+                    "file_path": f"documents/{file_id}.zip"}
+        if method in ("sendMessage", "editMessageText"):
+            chat_id = int(params["chat_id"])
+            reply_markup = json.loads(params["reply_markup"]) if params.get("reply_markup") else None
+            message = self._message(chat_id, params["text"], reply_markup)
+            if method == "editMessageText":
+                message["message_id"] = int(params["message_id"])
+            self.replies(chat_id).put_nowait((time.perf_counter(), method, message))
+            return message
+        raise KeyError(method)
+
+    async def _handle(self, reader, writer):
+        task = asyncio.current_task()
+        self.connections.add(task)
+        try:
+            while True:
+                request = await newhost.read_http_request(reader, max_body=64 * 1024 ** 2)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                if path.startswith("/file/bot"):
+                    file_id = path.rsplit("/", 1)[-1][:-len(".zip")]
+                    newhost.write_http_response(writer, 200, self.files[file_id], "application/zip")
+                else:
+                    api_method = path.rsplit("/", 1)[-1]
+                    params = {key: values[0] for key, values in urllib.parse.parse_qs(body.decode()).items()}
+                    if headers.get("content-type", "").startswith("application/json") and body:
+                        params = json.loads(body)
+                    try:
+                        result = {"ok": True, "result": await self._call(api_method, params)}
+                    except KeyError as e:
+                        result = {"ok": False, "error_code": 400, "description": f"unsupported: {e}"}
+                    newhost.write_http_response(writer, 200, json.dumps(result).encode(), "application/json")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            self.connections.discard(task)
+            writer.close()
+
+def make_bot_archive(with_token):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("main.py", BOT_WITH_TOKEN if with_token else BOT_WITHOUT_TOKEN)
+        archive.writestr("helpers/util.py", "VALUE = 1\n" * 200)
+    return buffer.getvalue()
+
+class SimulatedUser:
+    """Drives one user's conversations with the host and records latencies."""
+
+    def __init__(self, api, user_id, results):
+        self.api = api
+        self.user_id = user_id
+        self.user = {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+        self.chat = {"id": user_id, "type": "private"}
+        self.results = results
+        self.message_ids = itertools.count(1)
+
+    def _send_message(self, text=None, document=None):
+        message = {"message_id": next(self.message_ids), "date": int(time.time()),
+                   "chat": self.chat, "from": self.user}
+        if text is not None:
+            message["text"] = text
+            if text.startswith("/"):
+                message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        if document is not None:
+            message["document"] = document
+        self.api.push_update({"message": message})
+        return time.perf_counter()
+
+    def _press(self, message, data):
+        self.api.push_update({"callback_query": {
+            "id": str(next(self.message_ids)), "from": self.user, "chat_instance": str(self.user_id),
+            "message": message, "data": data,
+        }})
+        return time.perf_counter()
+
+    async def _reply(self, handler, sent_at, *needles):
+        """Waits for a message containing one of needles and records the handler latency."""
+        queue = self.api.replies(self.user_id)
+        while True:
+            received_at, _, message = await asyncio.wait_for(queue.get(), REPLY_TIMEOUT)
+            if any(needle in message["text"] for needle in needles):
+                self.results["handlers"].setdefault(handler, []).append(received_at - sent_at)
+                return received_at, message
+
+    async def deploy(self, with_token):
+        file_id = f"zip{self.user_id}"
+        archive = make_bot_archive(with_token)
+        self.api.add_file(file_id, archive)
+
+        sent = self._send_message("/new")
+        await self._reply("new_script_start", sent, "zip file")
+        sent = self._send_message(document={"file_id": file_id, "file_unique_id": file_id, "file_name": "bot.zip",
+                                            "mime_type": "application/zip", "file_size": len(archive)})
+        await self._reply("new_script_zip_file", sent, "Zip file received")
+        deploy_started = self._send_message("main.py")
+        _, message = await self._reply("new_script_main_file_name", deploy_started,
+                                       "started successfully", "Failed to start", "Does your script require",
+                                       "rejected", "Error")
+        if "Does your script require" in message["text"]:
+            sent = self._press(message, "needs_token_no")
+            _, message = await self._reply("new_script_check_bot_token", sent, "started successfully", "Failed to start")
+        if "started successfully" not in message["text"]:
+            self.results["failed_deploys"] += 1
+            return
+        self.results["deploy_latency"].append(time.perf_counter() - deploy_started)
+
+    async def list_and_remove(self):
+        sent = self._send_message("/all")
+        _, message = await self._reply("all_bots_command", sent, "Your hosted bots", "no bots hosted")
+        for row in message.get("reply_markup", {}).get("inline_keyboard", []):
+            sent = self._press(message, row[0]["callback_data"])
+            await self._reply("remove_bot_command_callback", sent, "stopped and removed", "Could not find")
+
+async def monitor_event_loop(lags, interval=0.05):
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - started - interval)
+
+def host_rss():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+    return {"count": len(values), "mean": statistics.fmean(values), "p50": pick(0.50),
+            "p90": pick(0.90), "p99": pick(0.99), "max": values[-1]}
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+async def run_benchmark(users, workdir):
+    newhost.SCRIPTS_DIR = os.path.join(workdir, "user_scripts")
+    newhost.ENVS_DIR = os.path.join(workdir, "envs")
+    newhost.WHEEL_CACHE_DIR = os.path.join(newhost.ENVS_DIR, ".wheels")
+    newhost.LOGS_DIR = os.path.join(workdir, "bot_logs")
+    newhost.DEFAULT_PYTHON = sys.executable
+    newhost.METRICS_PORT = 0
+    newhost.JSON_LOGS = False
+    for path in (newhost.SCRIPTS_DIR, newhost.ENVS_DIR, newhost.LOGS_DIR):
+        os.makedirs(path, exist_ok=True)
+    newhost.open_registry(os.path.join(workdir, "registry.sqlite3"))
+
+    api = FakeBotAPI()
+    await api.start()
+    application = newhost.build_application(FAKE_TOKEN, api.base_url, api.base_file_url)
+    results = {"handlers": {}, "deploy_latency": [], "failed_deploys": 0}
+    lags = []
+    peak = {"rss": host_rss(), "processes": 0}
+
+    async def sample_host():
+        while True:
+            peak["rss"] = max(peak["rss"], host_rss())
+            peak["processes"] = max(peak["processes"], len(newhost.running_processes))
+            await asyncio.sleep(0.1)
+
+    await application.initialize()
+    await newhost.on_startup(application)
+    await application.updater.start_polling(poll_interval=0, timeout=1)
+    await application.start()
+    monitors = [asyncio.create_task(monitor_event_loop(lags)), asyncio.create_task(sample_host())]
+    started = time.perf_counter()
+    try:
+        simulated = [SimulatedUser(api, 1000 + i, results) for i in range(users)]
+        await asyncio.gather(*(user.deploy(with_token=i % 2 == 0) for i, user in enumerate(simulated)))
+        launched = len(newhost.running_processes)
+        await asyncio.gather(*(user.list_and_remove() for user in simulated))
+    finally:
+        elapsed = time.perf_counter() - started
+        for monitor in monitors:
+            monitor.cancel()
+        await application.updater.stop()
+        await application.stop()
+        await newhost.on_shutdown(application)
+        await application.shutdown()
+        await api.stop()
+
+    return {
+        "revision": git_revision(),
+        "users": users,
+        "elapsed": elapsed,
+        "deploy_latency": percentiles(results["deploy_latency"]),
+        "failed_deploys": results["failed_deploys"],
+        "handler_latency": {name: percentiles(values) for name, values in results["handlers"].items()},
+        "event_loop_lag": percentiles(lags),
+        "host_rss_peak": peak["rss"],
+        "host_rss_end": host_rss(),
+        "processes_launched": launched,
+        "processes_peak": peak["processes"],
+        "processes_left": len(newhost.running_processes),
+        "api_calls": api.calls,
+        "host_metrics": newhost.render_metrics_json(),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=10, help="concurrent simulated users")
+    parser.add_argument("--output", help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_host-")
+    try:
+        report = asyncio.run(run_benchmark(args.users, workdir))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,28 @@
 import os
+import io
+import sys
+import signal
+import stat
+import time
 import zipfile
 import subprocess
 import asyncio
 import shutil
 import re
+import hashlib
+import sqlite3
 import tempfile
+import json
+import base64
+import socket
+import secrets
+import bisect
+import functools
+import contextlib
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import ParseMode
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, filters,
     ConversationHandler, CallbackQueryHandler, CallbackContext
@@ -17,12 +34,272 @@ SCRIPTS_DIR = "user_scripts"
 REQUIREMENTS_FILE = "requirements.txt"
 MAIN_FILE_REGEX = r"main\.py$"
 BOT_TOKEN_REGEX = r"(BOT_TOKEN|TELEGRAM_BOT_TOKEN|TOKEN)\s*=\s*[\'\"]([^\'\"]+)[\'\"]"
+DEFAULT_PYTHON = "python3"
+ENVS_DIR = "envs"  # One read-only venv per distinct requirements.txt hash
+WHEEL_CACHE_DIR = os.path.join(ENVS_DIR, ".wheels")
+ENV_CACHE_MAX_BYTES = 5 * 1024 ** 3  # LRU eviction kicks in above this
+REQUIREMENT_NAME_REGEX = r"([A-Za-z0-9][A-Za-z0-9._-]*)\s*(\[|[<>=!~;@]|$)"
+PROJECT_NAME_REGEX = r"[A-Za-z0-9]([A-Za-z0-9._-]*[A-Za-z0-9])?"  # PEP 508
+LOCAL_ARCHIVE_SUFFIXES = (".whl", ".tar.gz", ".tgz", ".tar.bz2", ".zip")
+DEPLOY_WORKERS = 4  # Threads for blocking download/extract/cleanup work
+MAX_UPLOAD_BYTES = 100 * 1024 ** 2
+MAX_ARCHIVE_FILES = 5000
+MAX_ARCHIVE_BYTES = 500 * 1024 ** 2  # Total uncompressed size
+MAX_COMPRESSION_RATIO = 100  # Per member, guards against zip bombs
+EXTRACT_CHUNK_SIZE = 1024 ** 2
+PROGRESS_INTERVAL = 2  # Seconds between progress message edits
+REGISTRY_DB = "host_registry.sqlite3"
+REGISTRY_COLUMNS = {"stop_reason": "TEXT", "webhook_secret": "TEXT"}  # Columns added after the first schema, migrated on open
+REVISIONS_DIR = "revisions"  # Files replaced by the last /update of each bot, for /rollback
+ADOPTED_POLL_INTERVAL = 5  # Fallback exit polling for re-adopted bots without pidfd support
+LOGS_DIR = "bot_logs"
+LOG_RING_LINES = 500  # Lines kept in memory per bot
+LOG_FILE_MAX_BYTES = 1024 ** 2  # Log file is rotated to <name>.log.1 above this
+LOG_TAIL_INTERVAL = 1  # Seconds between passes that read new bot output into memory
+LOG_MAX_LINE = 4096  # Longer lines are split
+LOGS_DEFAULT_LINES = 20
+LOGS_MAX_LINES = 100
+LOG_FOLLOW_SECONDS = 120
+LOG_FOLLOW_INTERVAL = 3
+STATS_INTERVAL = 5  # Seconds between /proc sampling passes
+STATS_HISTORY = 120  # Points kept per bot
+BOT_MAX_RSS_MB = 512
+BOT_MAX_CPU_PERCENT = 90
+RSS_STOP_SAMPLES = 2  # Consecutive samples above BOT_MAX_RSS_MB before stopping
+CPU_THROTTLE_SAMPLES = 3  # Consecutive samples above BOT_MAX_CPU_PERCENT before renicing
+CPU_STOP_SAMPLES = 24  # ...and before stopping
+ADMIN_USER_IDS = set()  # Telegram user IDs allowed to see host-wide /stats
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+ZYGOTE_ENABLED = False  # Fork bots from a warm template process instead of a cold interpreter
+ZYGOTE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "zygote.py")
+ZYGOTE_DIR = "zygotes"  # Control sockets, one zygote per interpreter
+ZYGOTE_PRELOAD = ["asyncio", "json", "ssl", "httpx", "telegram", "telegram.ext"]
+ZYGOTE_START_TIMEOUT = 30
+INPROCESS_ENABLED = False  # Run bots that define TENANT_FACTORY inside shared tenant workers
+TENANT_FACTORY = "setup_handlers"
+TENANT_WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tenant_worker.py")
+TENANT_WORKERS = 4
+TENANT_DIR = "tenants"  # Control sockets of the tenant workers
+TELEGRAM_API_BASE = "https://api.telegram.org/bot"  # Point at a local fake Bot API for testing
+TELEGRAM_FILE_BASE = "https://api.telegram.org/file/bot"
+WEBHOOK_ENABLED = False  # Receive updates through the local ingress gateway instead of polling
+WEBHOOK_LISTEN = "127.0.0.1"
+WEBHOOK_PORT = 8443
+WEBHOOK_PUBLIC_URL = ""  # Public base URL that reaches WEBHOOK_LISTEN:WEBHOOK_PORT, e.g. https://host.example.com
+WEBHOOK_SOCKETS_DIR = "webhooks"  # Unix sockets hosted bots listen on for forwarded updates
+WEBHOOK_QUEUE_SIZE = 100  # Pending updates per bot before the gateway answers 503
+WEBHOOK_MAX_BODY = 1024 ** 2
+WEBHOOK_RETRY_DELAY = 1  # Seconds between delivery attempts to a bot that is not listening
+DEPLOY_JOB_WORKERS = 4  # Deploy jobs running at once; the rest wait in the queue
+EXTRACT_CONCURRENCY = 2
+INSTALL_CONCURRENCY = 2
+LAUNCH_CONCURRENCY = 4
+QUEUE_POSITION_INTERVAL = 3  # Seconds between queue position updates
+METRICS_LISTEN = "127.0.0.1"
+METRICS_PORT = 9464  # Prometheus endpoint at /metrics (JSON at /metrics.json); 0 disables it
+JSON_LOGS = True  # Emit structured JSON log lines for handler errors, deploy stages and bot exits
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+LOOP_LAG_INTERVAL = 0.5
+HIBERNATE_ENABLED = False  # Freeze or stop bots that have been idle for IDLE_TIMEOUT
+HIBERNATE_MODE = "freeze"  # "freeze" (SIGSTOP/SIGCONT, fast resume) or "stop" (frees memory, cold start)
+IDLE_TIMEOUT = 3600
+IDLE_CPU_PERCENT = 0.5  # CPU use per sample above this counts as activity
+WAKE_POLL_INTERVAL = 10  # Seconds between getUpdates peeks for hibernated bots
+WAKE_CONSUME_TIMEOUT = 60  # How long to watch for the woken bot to consume its pending update
+WEBHOOK_DELIVERY_TIMEOUT = 30
+STOP_TIMEOUT = 10  # Seconds between SIGTERM and SIGKILL
+WORKER_AGENTS = []  # Agent addresses ("host:port" or "unix:/path"); when set, bots run there instead of locally
+AGENT_SECRET_FILE = "agent_secret"  # Shared secret for WORKER_AGENTS, one line in a mode 0600 file
+HOST_ONLY_ENV = ("AGENT_SECRET", "AGENT_SECRET_FILE")  # Never passed on to bots, pip or helper processes
+AGENT_TIMEOUT = 10
+AGENT_LAUNCH_TIMEOUT = 900  # Covers extraction and requirements install on the agent
+AGENT_MAX_REPLY = 16 * 1024 ** 2
+AGENT_CHECK_INTERVAL = 15
+AGENT_FAILOVER_CHECKS = 3  # Consecutive failed checks before an agent's bots are placed elsewhere
+PLACEMENT_RESERVE_MB = 256  # Memory kept free on every worker
+BOT_DEFAULT_RSS_MB = 64  # Expected footprint of a new bot until real samples exist
+BOT_DEFAULT_CPU_PERCENT = 5
+RESTART_BACKOFF_INITIAL = 1
+RESTART_BACKOFF_MAX = 300
+RESTART_RESET_AFTER = 60  # A run this long resets the backoff delay
+CRASH_LOOP_WINDOW = 600
+CRASH_LOOP_MAX_RESTARTS = 5  # Crashes within CRASH_LOOP_WINDOW before giving up
 
 # --- Global Data Structures ---
 user_scripts = {}
 running_processes = {}
+env_build_locks = {}
+registry = None  # sqlite3 connection, opened by open_registry()
+bot_logs = {}  # script_name -> deque of recent output lines
+log_tails = {}  # script_name -> {"inode", "offset", "partial"} of the followed log file
+background_tasks = set()  # Strong references to fire-and-forget tasks
+bot_stats = {}  # script_name -> resource time series and limit counters
+zygotes = {}  # interpreter -> {"process", "socket"}
+zygote_locks = {}
+tenant_workers = []  # [{"process", "socket", "tenants": set of script names}]
+tenant_workers_lock = None  # Created lazily on the running loop
+webhook_routes = {}  # secret path component -> route dict
+deploy_queues = OrderedDict()  # user_id -> deque of queued jobs, in round-robin order
+deploy_queue_ready = None  # asyncio.Condition, created by start_deploy_workers()
+stage_limits = {}  # stage name -> asyncio.Semaphore
+agent_secret = None  # Shared secret for WORKER_AGENTS, loaded by load_agent_secret()
+worker_agents = {}  # address -> {"status", "failures", "draining", "reserved_rss", "reserved_cpu"}
+deploy_executor = ThreadPoolExecutor(max_workers=DEPLOY_WORKERS, thread_name_prefix="deploy")
+log_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="logs")
+
+class ArchiveRejected(Exception):
+    """Raised when an uploaded archive breaks one of the extraction limits."""
+
+# --- Metrics ---
+histograms = {}  # (name, labels) -> [bucket counts..., +Inf count, sum]
+counters = {}  # (name, labels) -> value
+METRIC_HELP = {
+    "bot_crashes_total": "Bot processes that exited with a non-zero code.",
+    "bot_restarts_total": "Restarts performed by the supervisor after a crash.",
+    "bots_launched_total": "Bot processes started on this host.",
+    "bots_placed_total": "Bots launched on worker agents, by agent.",
+    "handler_errors_total": "Errors raised by host bot handlers.",
+    "deploy_stage_seconds": "Duration of each deploy stage.",
+    "event_loop_lag_seconds": "How late the event loop wakes a sleeping task.",
+    "handler_seconds": "Latency of host bot handlers.",
+    "wake_seconds": "Time to resume a hibernated bot.",
+    "wake_to_consume_seconds": "Time from waking a bot until it consumed its pending update.",
+    "bots": "Hosted bots by state.",
+    "deploy_jobs_queued": "Deploy jobs waiting for a worker.",
+}
+
+def observe(name, value, **labels):
+    """Records value in the histogram; one bisect and a few list updates per call."""
+    key = (name, tuple(sorted(labels.items())))
+    histogram = histograms.get(key)
+    if histogram is None:
+        histogram = histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+    histogram[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+    histogram[-1] += value
+
+def increment(name, amount=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    counters[key] = counters.get(key, 0) + amount
+
+def log_event(event, **fields):
+    """Writes one structured JSON log line."""
+    if JSON_LOGS:
+        print(json.dumps({"ts": round(time.time(), 3), "event": event, **fields}, default=str), flush=True)
+
+@contextlib.contextmanager
+def deploy_timer(stage):
+    """Times one deploy stage: download, extract, install, token_scan or launch."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        observe("deploy_stage_seconds", elapsed, stage=stage)
+        log_event("deploy_stage", stage=stage, seconds=round(elapsed, 4))
+
+def instrument_handler(callback, name=None):
+    """Wraps a handler callback so its latency lands in handler_seconds{handler=...}."""
+    name = name or callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            observe("handler_seconds", time.perf_counter() - started, handler=name)
+    return wrapper
+
+async def monitor_event_loop_lag():
+    """Measures how late the loop wakes a sleeping task, which is the delay every handler sees."""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        observe("event_loop_lag_seconds", max(0.0, time.perf_counter() - started - LOOP_LAG_INTERVAL))
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+def bot_state_counts():
+    states = {}
+    for scripts in user_scripts.values():
+        for bot in scripts.values():
+            states[bot.get("state", "unknown")] = states.get(bot.get("state", "unknown"), 0) + 1
+    return states
+
+def _metric_header(lines, name, kind):
+    if name in METRIC_HELP:
+        lines.append(f"# HELP {name} {METRIC_HELP[name]}")
+    lines.append(f"# TYPE {name} {kind}")
+
+def render_prometheus():
+    """Renders all metrics in the Prometheus text exposition format."""
+    lines = []
+    family = None
+    for (name, labels), value in sorted(counters.items()):
+        if name != family:
+            _metric_header(lines, name, "counter")
+            family = name
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+    for (name, labels), histogram in sorted(histograms.items()):
+        if name != family:
+            _metric_header(lines, name, "histogram")
+            family = name
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), histogram[:-1]):
+            cumulative += count
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {histogram[-1]}")
+        lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+    _metric_header(lines, "bots", "gauge")
+    for state, count in sorted(bot_state_counts().items()):
+        lines.append(f'bots{{state="{state}"}} {count}')
+    _metric_header(lines, "deploy_jobs_queued", "gauge")
+    lines.append(f"deploy_jobs_queued {sum(len(jobs) for jobs in deploy_queues.values())}")
+    return "\n".join(lines) + "\n"
+
+def render_metrics_json():
+    return {
+        "counters": [{"name": name, "labels": dict(labels), "value": value}
+                     for (name, labels), value in counters.items()],
+        "histograms": [{"name": name, "labels": dict(labels), "buckets": list(LATENCY_BUCKETS),
+                        "counts": histogram[:-1], "sum": histogram[-1]}
+                       for (name, labels), histogram in histograms.items()],
+        "bots": bot_state_counts(),
+    }
+
+async def _handle_metrics(reader, writer):
+    try:
+        request = await read_http_request(reader)
+        if request is None:
+            return
+        path = request[1]
+        if path == "/metrics":
+            write_http_response(writer, 200, render_prometheus().encode(), "text/plain; version=0.0.4")
+        elif path == "/metrics.json":
+            write_http_response(writer, 200, json.dumps(render_metrics_json()).encode(), "application/json")
+        else:
+            write_http_response(writer, 404)
+        await writer.drain()
+    except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def start_metrics_server():
+    if METRICS_PORT:
+        return await asyncio.start_server(_handle_metrics, METRICS_LISTEN, METRICS_PORT)
+    return None
 
 # --- Utility Functions ---
+def child_environment():
+    """The host's environment minus HOST_ONLY_ENV, for every process that runs user code."""
+    return {key: value for key, value in os.environ.items() if key not in HOST_ONLY_ENV}
+
 def extract_bot_token_variable_name(main_file_path):
     """Attempts to extract a potential environment variable name for the bot token from the main file."""
     try:
@@ -35,71 +312,1867 @@ def extract_bot_token_variable_name(main_file_path):
         print(f"Error reading main file to extract token variable: {e}")
     return "BOT_TOKEN"
 
+def _normalize_requirement(line):
+    """Normalizes the project name of a requirement line; options, URLs and paths are kept verbatim."""
+    match = re.match(REQUIREMENT_NAME_REGEX, line)
+    if match is None or "://" in line.split('@', 1)[0]:
+        return line
+    name = re.sub(r"[-_.]+", "-", match.group(1)).lower()
+    return name + re.sub(r"\s+", "", line[match.end(1):])
+
+def _is_local_requirement(line):
+    """True if a requirements line refers to local files: another requirements or constraints
+    file (-r, -c, with or without a space), a path or archive, or a file: URL.
+    """
+    if re.match(r"(-r|-c|--requirement|--constraint)", line) or "file:" in line:
+        return True
+    option = re.match(r"(-e|--editable|-f|--find-links)(\s*=?\s*)", line)
+    if option:
+        line = line[option.end():]
+    elif line.startswith('-'):
+        return False  # --index-url, --pre, --hash and other options
+    if re.match(r"[A-Za-z][A-Za-z0-9+.-]*://", line):
+        return False
+    target = re.match(r"[^\s@;\[<>=!~]*", line).group()
+    return (not re.fullmatch(PROJECT_NAME_REGEX, target)
+            or target.lower().endswith(LOCAL_ARCHIVE_SUFFIXES))
+
+def requirements_hash(requirements_path):
+    """Returns a hash of requirements.txt that ignores comments, blank lines and ordering.
+
+    Only project names are case- and separator-normalized. Returns None when a line
+    refers to local files (other requirement files, paths, wheels, file: URLs), whose
+    content is not part of the hash, so the environment must not be shared.
+    """
+    lines = set()
+    with open(requirements_path, 'r') as f:
+        for line in f:
+            line = re.sub(r"(^|\s)#.*$", "", line).strip()  # '#' inside URLs (#egg=, #sha256=) is not a comment
+            if not line:
+                continue
+            if _is_local_requirement(line):
+                return None
+            lines.add(_normalize_requirement(line))
+    return hashlib.sha256("\n".join(sorted(lines)).encode()).hexdigest()[:32]
+
+def env_python(env_path):
+    """Path of the interpreter inside a cached environment."""
+    return os.path.join(os.path.abspath(env_path), "bin", "python")
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+def _set_read_only(path, read_only=True):
+    """Drops (or restores) write permission on every entry below path."""
+    write_bits = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            entry = os.path.join(root, name)
+            if os.path.islink(entry):
+                continue
+            mode = os.lstat(entry).st_mode
+            os.chmod(entry, mode & ~write_bits if read_only else mode | stat.S_IWUSR)
+    mode = os.stat(path).st_mode
+    os.chmod(path, mode & ~write_bits if read_only else mode | stat.S_IWUSR)
+
+def _remove_env(env_path):
+    _set_read_only(env_path, read_only=False)
+    shutil.rmtree(env_path, ignore_errors=True)
+
+def environments_in_use():
+    """Absolute paths of the environments bots run from. Reads user_scripts, so call it on the event loop."""
+    return {os.path.dirname(os.path.dirname(data.get("python") or ""))
+            for scripts in user_scripts.values() for data in scripts.values()}
+
+def evict_environments(keep=()):
+    """Removes least recently used environments until the cache fits in ENV_CACHE_MAX_BYTES.
+
+    keep holds absolute paths that must survive, see environments_in_use().
+    """
+    if not os.path.isdir(ENVS_DIR):
+        return
+    envs = []
+    for name in os.listdir(ENVS_DIR):
+        env_path = os.path.join(ENVS_DIR, name)
+        if name.startswith('.') or not os.path.isdir(env_path):
+            continue
+        try:
+            with open(os.path.join(env_path, ".size"), 'r') as f:
+                size = int(f.read())
+        except (OSError, ValueError):
+            size = _dir_size(env_path)
+        envs.append((os.stat(env_path).st_mtime, size, env_path))
+
+    total = sum(size for _, size, _ in envs)
+    for _, size, env_path in sorted(envs):
+        if total <= ENV_CACHE_MAX_BYTES:
+            break
+        if os.path.abspath(env_path) in keep:
+            continue
+        _remove_env(env_path)
+        total -= size
+        print(f"Evicted dependency environment {env_path} ({size} bytes)")
+
+async def _build_environment(requirements_path, env_path, cwd):
+    """Builds a venv for requirements_path next to env_path and atomically moves it into place.
+
+    pip runs in cwd, the bot's directory, so relative requirements resolve as they did there.
+    """
+    build_path = tempfile.mkdtemp(prefix=".build-", dir=ENVS_DIR)
+    try:
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, "-m", "venv", build_path,
+            env=child_environment(),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+        if await process.wait() != 0:
+            return False
+        process = await asyncio.create_subprocess_exec(
+            os.path.join(build_path, "bin", "python"), "-m", "pip", "install",
+            "--disable-pip-version-check", "--cache-dir", os.path.abspath(WHEEL_CACHE_DIR),
+            "-r", os.path.abspath(requirements_path),
+            cwd=cwd,
+            env=child_environment(),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+        if await process.wait() != 0:
+            return False
+        # Only bin/python is ever used, and it locates the venv through pyvenv.cfg,
+        # so the rename does not break the environment.
+        os.rename(build_path, env_path)
+        with open(os.path.join(env_path, ".size"), 'w') as f:
+            f.write(str(_dir_size(env_path)))
+        _set_read_only(env_path)
+        return True
+    finally:
+        if os.path.exists(build_path):
+            shutil.rmtree(build_path, ignore_errors=True)
+
 async def install_requirements(script_path):
-    """Installs dependencies from requirements.txt if available."""
+    """Returns the interpreter for the script's requirements, building a cached environment if needed.
+
+    Environments are keyed by the normalized hash of requirements.txt, so identical
+    requirement sets share one prebuilt, read-only venv. Requirements that refer to
+    local files get a private environment built on every install. Returns None on failure.
+    """
     requirements_path = os.path.join(script_path, REQUIREMENTS_FILE)
-    if os.path.exists(requirements_path):
+    if not os.path.exists(requirements_path):
+        return DEFAULT_PYTHON
+
+    try:
+        key = requirements_hash(requirements_path)
+        if key is None:
+            # A fresh path each time, so a running bot keeps its old environment; LRU eviction reclaims it.
+            key = f"private-{os.path.basename(os.path.abspath(script_path))}-{time.time_ns()}"
+        env_path = os.path.join(ENVS_DIR, key)
+        lock = env_build_locks.setdefault(env_path, asyncio.Lock())
+        async with lock:
+            if not os.path.exists(env_python(env_path)):
+                os.makedirs(WHEEL_CACHE_DIR, exist_ok=True)
+                if not await _build_environment(requirements_path, env_path, script_path):
+                    print(f"Error installing requirements from {requirements_path}")
+                    return None
+                keep = environments_in_use() | {os.path.abspath(env_path)}
+                await run_in_deploy_pool(evict_environments, keep)
+        os.utime(env_path)  # LRU bookkeeping
+        return env_python(env_path)
+    except Exception as e:
+        print(f"Error installing requirements: {e}")
+        return None
+
+# --- Bot Registry ---
+def open_registry(db_path=REGISTRY_DB):
+    """Opens the SQLite bot registry in WAL mode, creating the schema if needed."""
+    global registry
+    # The registry holds bot tokens, so only the host's user may read it. SQLite gives the
+    # -wal/-shm files the database's mode; existing files from older versions are fixed up too.
+    os.close(os.open(db_path, os.O_CREAT | os.O_RDWR, 0o600))
+    registry = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+    registry.execute("PRAGMA journal_mode=WAL")
+    registry.execute("PRAGMA synchronous=NORMAL")
+    for path in (db_path, db_path + "-wal", db_path + "-shm"):
+        if os.path.exists(path):
+            os.chmod(path, 0o600)
+    registry.execute("""
+        CREATE TABLE IF NOT EXISTS bots (
+            script_name TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            path TEXT NOT NULL,
+            main_file TEXT NOT NULL,
+            python TEXT NOT NULL,
+            env_name TEXT NOT NULL,
+            bot_token TEXT,
+            pid INTEGER,
+            started_at REAL,
+            proc_start INTEGER,
+            stop_reason TEXT,
+            webhook_secret TEXT
+        )
+    """)
+    # Registries created by earlier versions lack the newer columns.
+    columns = {row[1] for row in registry.execute("PRAGMA table_info(bots)")}
+    for column, declaration in REGISTRY_COLUMNS.items():
+        if column not in columns:
+            registry.execute(f"ALTER TABLE bots ADD COLUMN {column} {declaration}")
+    registry.execute("CREATE INDEX IF NOT EXISTS bots_by_user ON bots (user_id)")
+    return registry
+
+def registry_save(bot):
+    """Writes the bot's record, including its current PID and start-time fingerprint."""
+    if registry is None:
+        return
+    registry.execute(
+        "INSERT OR REPLACE INTO bots (script_name, user_id, path, main_file, python, env_name, bot_token,"
+        " pid, started_at, proc_start, stop_reason, webhook_secret) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (bot["script_name"], bot["user_id"], bot["path"], bot["main_file"], bot["python"],
+         bot["env_name"], bot.get("bot_token"), bot.get("process"), bot.get("started_at"),
+         process_fingerprint(bot["process"]) if bot.get("process") else None, bot.get("stop_reason"),
+         bot.get("webhook_secret"))
+    )
+
+def registry_webhook_secret(script_name):
+    """The gateway secret the bot was last started with, or None."""
+    if registry is None:
+        return None
+    row = registry.execute("SELECT webhook_secret FROM bots WHERE script_name = ?", (script_name,)).fetchone()
+    return row[0] if row else None
+
+def registry_mark_stopped(bot, reason):
+    """Records why the bot was stopped for good, so recover_bots() does not relaunch it."""
+    bot["stop_reason"] = reason
+    if registry is not None:
+        registry.execute("UPDATE bots SET stop_reason = ?, pid = NULL, proc_start = NULL WHERE script_name = ?",
+                         (reason, bot["script_name"]))
+
+def registry_delete(script_name):
+    if registry is not None:
+        registry.execute("DELETE FROM bots WHERE script_name = ?", (script_name,))
+
+def process_fingerprint(pid):
+    """Returns the process start time in clock ticks since boot, or None if pid is not running.
+
+    Together with the PID this identifies a process across PID reuse.
+    """
+    try:
+        with open(f"/proc/{pid}/stat", 'r') as f:
+            stat_line = f.read()
+    except OSError:
+        return None
+    # The command name may contain spaces, so split after its closing parenthesis.
+    fields = stat_line[stat_line.rindex(')') + 2:].split()
+    return int(fields[19])
+
+class PidHandle:
+    """Minimal stand-in for asyncio.subprocess.Process for bots that are not our children.
+
+    Used for processes re-adopted after a host restart. Their exit status cannot be
+    collected, so returncode is -1 once they are gone.
+    """
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.returncode = None
+
+    async def wait(self):
+        if self.returncode is not None:
+            return self.returncode
+        try:
+            pidfd = os.pidfd_open(self.pid)
+        except (AttributeError, OSError):
+            pidfd = None
+        try:
+            if pidfd is not None:
+                loop = asyncio.get_running_loop()
+                exited = loop.create_future()
+                loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(None))
+                try:
+                    await exited
+                finally:
+                    loop.remove_reader(pidfd)
+            else:
+                while process_fingerprint(self.pid) is not None:
+                    await asyncio.sleep(ADOPTED_POLL_INTERVAL)
+        finally:
+            if pidfd is not None:
+                os.close(pidfd)
+        self.returncode = -1
+        return self.returncode
+
+class ZygoteChildHandle(PidHandle):
+    """PidHandle for a bot forked by a zygote, which reaps it and reports the exit
+    status on the launch connection. If the zygote goes away first, the status is
+    lost and this falls back to PidHandle.
+    """
+
+    def __init__(self, pid, conn):
+        super().__init__(pid)
+        self.conn = conn
+        self.exit = None
+
+    async def _read_status(self):
+        try:
+            reader, writer = await asyncio.open_unix_connection(sock=self.conn)
+            try:
+                line = await reader.readline()
+            finally:
+                writer.close()
+            self.returncode = json.loads(line)["returncode"]
+        except (OSError, ValueError, KeyError):
+            await PidHandle.wait(self)
+        return self.returncode
+
+    async def wait(self):
+        if self.exit is None:
+            self.exit = asyncio.ensure_future(self._read_status())
+        return await asyncio.shield(self.exit)
+
+async def recover_bots(application=None):
+    """Re-adopts registered bots that are still alive and relaunches the dead ones in parallel.
+
+    Bots that were stopped for good (limits, crash loop, clean exit) are listed but not started.
+    """
+    if registry is None:
+        return
+    rows = registry.execute(
+        "SELECT script_name, user_id, path, main_file, python, env_name, bot_token, pid, proc_start, stop_reason FROM bots"
+    ).fetchall()
+    relaunches = []
+    adopted = stopped = 0
+    for script_name, user_id, path, main_file, python, env_name, bot_token, pid, proc_start, stop_reason in rows:
+        if not os.path.isdir(path):
+            registry_delete(script_name)
+            continue
+        if stop_reason:
+            user_scripts.setdefault(user_id, {})[script_name] = {
+                "user_id": user_id, "script_name": script_name, "path": path, "main_file": main_file,
+                "python": python, "env_name": env_name, "bot_token": bot_token, "state": "stopped",
+                "restarts": 0, "stop_reason": stop_reason,
+            }
+            stopped += 1
+        elif pid and proc_start is not None and process_fingerprint(pid) == proc_start:
+            await run_script(user_id, script_name, path, main_file, bot_token=bot_token,
+                             bot_token_env_name=env_name, python_executable=python, adopt_pid=pid)
+            adopted += 1
+        else:
+            relaunches.append(_relaunch_bot(user_id, script_name, path, main_file, bot_token, env_name, python))
+    results = await asyncio.gather(*relaunches, return_exceptions=True)
+    failed = sum(1 for result in results if not result or isinstance(result, Exception))
+    print(f"Registry recovery: {adopted} re-adopted, {len(results) - failed} relaunched, {failed} failed, {stopped} kept stopped")
+
+async def _relaunch_bot(user_id, script_name, path, main_file, bot_token, env_name, python):
+    if python != DEFAULT_PYTHON and not os.path.exists(python):
+        # The cached environment was evicted while the host was down.
+        python = await install_requirements(path) or DEFAULT_PYTHON
+    return await run_script(user_id, script_name, path, main_file, bot_token=bot_token,
+                            bot_token_env_name=env_name, python_executable=python)
+
+# --- Bot Logs ---
+# Bots write straight into their append-only log file, so their output outlives the host:
+# a re-adopted bot keeps logging, and log_tailer() picks up where it left off. All log
+# file I/O runs on log_executor, a single thread that also keeps host lines in order.
+def log_file_path(script_name):
+    return os.path.join(LOGS_DIR, f"{script_name}.log")
+
+async def run_in_log_pool(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(log_executor, func, *args)
+
+def open_log_output(script_name):
+    """Opens the bot's log file for appending and returns the descriptor to hand to the child."""
+    return os.open(log_file_path(script_name), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+
+def _append_log_file(path, data):
+    with open(path, 'ab') as f:
+        f.write(data)
+
+def record_log_line(script_name, line):
+    """Adds a host-generated line (exits, restarts) to the bot's log without blocking the loop."""
+    line = f"[host {time.strftime('%Y-%m-%d %H:%M:%S')}] {line}"
+    log_tails.setdefault(script_name, {"inode": None, "offset": 0, "partial": b""})
+    log_executor.submit(_append_log_file, log_file_path(script_name), (line + "\n").encode())
+
+def follow_log(script_name):
+    """Starts tailing the bot's log file; a host that just started reads the existing lines too."""
+    log_tails.setdefault(script_name, {"inode": None, "offset": 0, "partial": b""})
+
+def _read_new_output(script_name, tail):
+    """Returns the complete lines appended since the last pass and rotates the file when it is full.
+
+    Rotation copies the file to <name>.log.1 and truncates it in place (the bot keeps its
+    descriptor); output written between the copy and the truncate is lost.
+    """
+    path = log_file_path(script_name)
+    try:
+        with open(path, 'rb') as f:
+            info = os.fstat(f.fileno())
+            if info.st_ino != tail["inode"] or info.st_size < tail["offset"]:
+                tail.update(inode=info.st_ino, offset=0, partial=b"")  # Replaced or truncated
+            # Only the last LOG_RING_LINES lines are kept, so a large backlog is skipped.
+            start = max(tail["offset"], info.st_size - LOG_RING_LINES * LOG_MAX_LINE)
+            if start > tail["offset"]:
+                tail["partial"] = b""
+            f.seek(start)
+            data = f.read(info.st_size - start)
+        tail["offset"] = start + len(data)
+        if tail["offset"] > LOG_FILE_MAX_BYTES:
+            shutil.copyfile(path, path + ".1")
+            os.truncate(path, 0)
+            tail["offset"] = 0
+    except FileNotFoundError:
+        return []
+    lines = (tail["partial"] + data).split(b"\n")
+    partial = lines.pop()
+    while len(partial) > LOG_MAX_LINE:
+        lines.append(partial[:LOG_MAX_LINE])
+        partial = partial[LOG_MAX_LINE:]
+    tail["partial"] = partial
+    return [line.decode(errors='replace') for line in lines]
+
+def _read_all_output(tails):
+    new_lines = {}
+    for script_name, tail in tails:
+        try:
+            new_lines[script_name] = _read_new_output(script_name, tail)
+        except OSError as e:
+            print(f"Error reading output of {script_name}: {e}")
+    return new_lines
+
+async def log_tailer():
+    """Moves new output of every followed bot into its ring buffer every LOG_TAIL_INTERVAL seconds."""
+    while True:
+        await asyncio.sleep(LOG_TAIL_INTERVAL)
+        try:
+            new_lines = await run_in_log_pool(_read_all_output, list(log_tails.items()))
+            for script_name, lines in new_lines.items():
+                if lines and script_name in log_tails:
+                    bot_logs.setdefault(script_name, deque(maxlen=LOG_RING_LINES)).extend(lines)
+        except Exception as e:
+            print(f"Error tailing bot logs: {e}")
+
+def tail_log_file(script_name, lines):
+    """Returns the last lines of the bot's log file, for bots whose output is not in memory yet."""
+    path = log_file_path(script_name)
+    try:
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - LOG_MAX_LINE * lines))
+            data = f.read()
+    except OSError:
+        return []
+    return data.decode(errors='replace').splitlines()[-lines:]
+
+async def recent_log_lines(script_name, lines):
+    ring = bot_logs.get(script_name)
+    if ring:
+        return list(ring)[-lines:]
+    return await run_in_log_pool(tail_log_file, script_name, lines)
+
+def discard_bot_logs(script_name):
+    bot_logs.pop(script_name, None)
+    log_tails.pop(script_name, None)
+    for path in (log_file_path(script_name), log_file_path(script_name) + ".1"):
+        remove_path(path)
+
+# --- Process Supervisor ---
+def _bot_record(user_id, script_name):
+    return user_scripts.get(user_id, {}).get(script_name)
+
+def _signal_group(pid, sig):
+    """Signals the bot's whole session; bots are started as session leaders so pgid == pid."""
+    try:
+        os.killpg(pid, sig)
+        return True
+    except ProcessLookupError:
+        return False
+
+# --- Zygote Launcher ---
+async def _start_zygote(python):
+    """Starts a zygote for the interpreter and waits until its control socket accepts connections."""
+    os.makedirs(ZYGOTE_DIR, exist_ok=True)
+    socket_path = os.path.abspath(os.path.join(ZYGOTE_DIR, hashlib.sha256(python.encode()).hexdigest()[:16] + ".sock"))
+    process = await asyncio.create_subprocess_exec(
+        python, ZYGOTE_SCRIPT, socket_path, *ZYGOTE_PRELOAD,
+        env=child_environment(),
+        start_new_session=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + ZYGOTE_START_TIMEOUT
+    while time.monotonic() < deadline and process.returncode is None:
         try:
+            _, writer = await asyncio.open_unix_connection(socket_path)
+            writer.close()
+            return {"process": process, "socket": socket_path}
+        except OSError:
+            await asyncio.sleep(0.1)
+    if process.returncode is None:
+        process.kill()
+    raise RuntimeError(f"zygote for {python} did not start")
+
+async def _get_zygote(python):
+    lock = zygote_locks.setdefault(python, asyncio.Lock())
+    async with lock:
+        zygote = zygotes.get(python)
+        if zygote is None or zygote["process"].returncode is not None:
+            zygote = zygotes[python] = await _start_zygote(python)
+        return zygote
+
+def _zygote_request(socket_path, request, output_fd):
+    """Sends one launch request with the output descriptor and returns (pid, connection).
+
+    The zygote reports the child's exit status on the connection later, see ZygoteChildHandle.
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.settimeout(ZYGOTE_START_TIMEOUT)
+        conn.connect(socket_path)
+        socket.send_fds(conn, [json.dumps(request).encode() + b"\n"], [output_fd])
+        reply = b""
+        while not reply.endswith(b"\n"):
+            chunk = conn.recv(1)  # Byte by byte: the exit status line may follow right away
+            if not chunk:
+                break
+            reply += chunk
+        reply = json.loads(reply)
+        if "pid" not in reply:
+            raise RuntimeError(f"zygote launch failed: {reply.get('error')}")
+    except BaseException:
+        conn.close()
+        raise
+    conn.setblocking(False)
+    return reply["pid"], conn
+
+async def _zygote_spawn(bot, output_fd):
+    """Forks the bot from its interpreter's zygote with output_fd as stdout/stderr; returns a ZygoteChildHandle."""
+    zygote = await _get_zygote(bot["python"])
+    request = {"cwd": os.path.abspath(bot["path"]), "env": bot["env"], "main_file": bot["main_file"]}
+    pid, conn = await asyncio.to_thread(_zygote_request, zygote["socket"], request, output_fd)
+    return ZygoteChildHandle(pid, conn)
+
+async def stop_zygotes():
+    for zygote in zygotes.values():
+        if zygote["process"].returncode is None:
+            zygote["process"].terminate()
+            await zygote["process"].wait()
+    zygotes.clear()
+
+async def _spawn_bot(bot):
+    """Starts one instance of the bot described by the record and marks it running."""
+    bot["state"] = "starting"
+    process = None
+    output_fd = await run_in_log_pool(open_log_output, bot["script_name"])
+    try:
+        if ZYGOTE_ENABLED:
+            try:
+                process = await _zygote_spawn(bot, output_fd)
+            except Exception as e:
+                print(f"Zygote launch of {bot['script_name']} failed, falling back to a cold start: {e}")
+        if process is None:
             process = await asyncio.create_subprocess_exec(
-                "pip", "install", "-r", requirements_path,
-                cwd=script_path,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL
+                bot["python"], bot["main_file"],
+                cwd=bot["path"],
+                env=bot["env"],
+                start_new_session=True, # For independent process group
+                stdout=output_fd,
+                stderr=subprocess.STDOUT
             )
-            await process.wait()
-            return True
-        except subprocess.CalledProcessError as e:
-            print(f"Error installing requirements: {e}")
-            return False
-    return True
+    finally:
+        os.close(output_fd)
+    follow_log(bot["script_name"])
+    bot["handle"] = process
+    bot["process"] = process.pid
+    bot["started_at"] = time.time()
+    bot["last_active"] = time.monotonic()
+    bot["state"] = "running"
+    running_processes[process.pid] = {"user_id": bot["user_id"], "script_name": bot["script_name"]}
+    registry_save(bot)
+    increment("bots_launched_total")
+    return process
+
+def _adopt_bot(bot, pid):
+    """Attaches the record to an already running bot process instead of starting a new one."""
+    process = PidHandle(pid)
+    _signal_group(pid, signal.SIGCONT)  # It may have been frozen when the previous host exited
+    follow_log(bot["script_name"])  # It still writes to its log file
+    bot["handle"] = process
+    bot["process"] = pid
+    bot["started_at"] = time.time()
+    bot["last_active"] = time.monotonic()
+    bot["state"] = "running"
+    running_processes[pid] = {"user_id": bot["user_id"], "script_name": bot["script_name"]}
+    return process
 
-async def run_script(user_id, script_name, script_path, main_file, bot_token=None, bot_token_env_name="BOT_TOKEN"):
-    """Runs the user's Python script as a background process."""
-    main_file_path = os.path.join(script_path, main_file)
-    env = os.environ.copy()
+async def _supervise_bot(bot, launched, adopt_pid=None):
+    """Keeps the bot running: reaps every exit and restarts crashes with exponential backoff.
+
+    Exit code 0 stops the bot instead.
+    """
+    crashes = []
+    delay = RESTART_BACKOFF_INITIAL
+    while bot["state"] != "stopping":
+        try:
+            if adopt_pid:
+                process, adopt_pid = _adopt_bot(bot, adopt_pid), None
+            else:
+                process = await _spawn_bot(bot)
+        except Exception as e:
+            print(f"Error running script {bot['script_name']}: {e}")
+            process = None
+        if not launched.done():
+            launched.set_result(process.pid if process else None)
+            if process is None:
+                bot["state"] = "stopped"
+                return
+        if process is not None:
+            returncode = await process.wait()
+            running_processes.pop(process.pid, None)
+            bot["handle"] = None
+            if bot["state"] == "stopping":
+                break
+            if returncode == 0:
+                # A clean exit is on purpose: the bot is done, not crashed.
+                record_log_line(bot["script_name"], f"process {process.pid} exited cleanly, not restarting")
+                log_event("bot_exit", bot=bot["script_name"], pid=process.pid, returncode=0)
+                registry_mark_stopped(bot, "exited")
+                break
+            print(f"Bot {bot['script_name']} (PID {process.pid}) exited with code {returncode}")
+            increment("bot_crashes_total")
+            log_event("bot_exit", bot=bot["script_name"], pid=process.pid, returncode=returncode)
+            record_log_line(bot["script_name"], f"process {process.pid} exited with code {returncode}")
+            if time.time() - bot["started_at"] >= RESTART_RESET_AFTER:
+                delay = RESTART_BACKOFF_INITIAL
+        bot["last_exit"] = process.returncode if process else None
+
+        now = time.time()
+        crashes = [t for t in crashes if now - t < CRASH_LOOP_WINDOW] + [now]
+        if len(crashes) > CRASH_LOOP_MAX_RESTARTS:
+            print(f"Bot {bot['script_name']} is crash-looping, giving up after {len(crashes)} crashes")
+            record_log_line(bot["script_name"], f"crash loop detected, not restarting after {len(crashes)} crashes")
+            registry_mark_stopped(bot, f"crash loop ({len(crashes)} crashes)")
+            bot["state"] = "stopped"
+            return
+        bot["state"] = "backoff"
+        bot["restarts"] = bot.get("restarts", 0) + 1
+        increment("bot_restarts_total")
+        record_log_line(bot["script_name"], f"restarting in {delay}s")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, RESTART_BACKOFF_MAX)
+    bot["state"] = "stopped"
+
+# --- Multi-tenant Workers ---
+def tenant_token(script_path, main_file, python_executable, bot_token):
+    """Returns the token to host the bot in a tenant worker, or None if it must run as its own process.
+
+    Tenants share the host's interpreter, so bots with their own requirements are excluded.
+    """
+    if not INPROCESS_ENABLED or python_executable != DEFAULT_PYTHON:
+        return None
+    try:
+        with open(os.path.join(script_path, main_file), 'r') as f:
+            content = f.read()
+    except OSError:
+        return None
+    if not re.search(rf"^def {TENANT_FACTORY}\s*\(", content, re.MULTILINE):
+        return None
     if bot_token:
-        env[bot_token_env_name] = bot_token
+        return bot_token
+    match = re.search(BOT_TOKEN_REGEX, content, re.IGNORECASE)
+    return match.group(2) if match else None
 
+async def _tenant_call(worker, request):
+    reader, writer = await asyncio.open_unix_connection(worker["socket"])
     try:
+        writer.write(json.dumps(request).encode() + b"\n")
+        await writer.drain()
+        reply = json.loads(await reader.readline())
+    finally:
+        writer.close()
+    if not reply.get("ok"):
+        raise RuntimeError(reply.get("error"))
+    return reply.get("result")
+
+async def _start_tenant_worker(index):
+    os.makedirs(TENANT_DIR, exist_ok=True)
+    socket_path = os.path.abspath(os.path.join(TENANT_DIR, f"worker{index}.sock"))
+    os.makedirs(LOGS_DIR, exist_ok=True)
+    with open(os.path.join(LOGS_DIR, f"tenant_worker{index}.log"), 'ab') as worker_log:
         process = await asyncio.create_subprocess_exec(
-            "python3", main_file,
-            cwd=script_path,
-            env=env,
-            start_new_session=True, # For independent process group
+            sys.executable, TENANT_WORKER_SCRIPT, socket_path,
+            env=child_environment(),
+            start_new_session=True,
             stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL
+            stderr=worker_log
         )
-        process_id = process.pid
-        running_processes[process_id] = {"user_id": user_id, "script_name": script_name}
+    worker = {"process": process, "socket": socket_path, "tenants": set()}
+    deadline = time.monotonic() + ZYGOTE_START_TIMEOUT
+    while time.monotonic() < deadline and process.returncode is None:
+        try:
+            await _tenant_call(worker, {"op": "status"})
+            break
+        except OSError:
+            await asyncio.sleep(0.1)
+    else:
+        if process.returncode is None:
+            process.kill()
+        raise RuntimeError(f"tenant worker {index} did not start")
+    task = asyncio.create_task(_watch_tenant_worker(index, worker))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return worker
+
+async def _watch_tenant_worker(index, worker):
+    """Restarts a tenant worker that died and moves its tenants onto the new one."""
+    returncode = await worker["process"].wait()
+    if index >= len(tenant_workers) or tenant_workers[index] is not worker:
+        return  # Deliberately stopped
+    print(f"Tenant worker {index} exited with code {returncode}, restarting it")
+    tenant_workers[index] = replacement = await _start_tenant_worker(index)
+    bots = [bot for scripts in user_scripts.values() for bot in scripts.values()
+            if bot.get("worker") == index and bot.get("state") == "running"]
+    for bot in bots:
+        record_log_line(bot["script_name"], f"tenant worker {index} crashed, restarting tenant")
+        try:
+            await _tenant_call(replacement, _tenant_start_request(bot))
+            replacement["tenants"].add(bot["script_name"])
+        except Exception as e:
+            print(f"Error restarting tenant {bot['script_name']}: {e}")
+            bot["state"] = "stopped"
 
-        if user_id not in user_scripts:
-            user_scripts[user_id] = {}
-        if script_name not in user_scripts[user_id]:
-            user_scripts[user_id][script_name] = {}
+def _tenant_start_request(bot):
+    return {"op": "start", "name": bot["script_name"], "path": os.path.abspath(bot["path"]),
+            "main_file": bot["main_file"], "token": bot["tenant_token"],
+            "log_file": os.path.abspath(log_file_path(bot["script_name"])),
+            "base_url": TELEGRAM_API_BASE, "base_file_url": TELEGRAM_FILE_BASE}
 
-        user_scripts[user_id][script_name]["path"] = script_path
-        user_scripts[user_id][script_name]["process"] = process_id
-        return process_id
+async def _start_tenant(bot, token):
+    """Places the bot on the least loaded tenant worker. Returns the worker's PID or None."""
+    global tenant_workers_lock
+    if tenant_workers_lock is None:
+        tenant_workers_lock = asyncio.Lock()
+    try:
+        async with tenant_workers_lock:
+            while len(tenant_workers) < TENANT_WORKERS:
+                tenant_workers.append(await _start_tenant_worker(len(tenant_workers)))
+        index = min(range(len(tenant_workers)), key=lambda i: len(tenant_workers[i]["tenants"]))
+        worker = tenant_workers[index]
+        bot.update({"mode": "tenant", "worker": index, "tenant_token": token, "process": None})
+        await _tenant_call(worker, _tenant_start_request(bot))
+        follow_log(bot["script_name"])
     except Exception as e:
-        print(f"Error running script: {e}")
+        print(f"Error starting tenant {bot['script_name']}: {e}")
+        bot["state"] = "stopped"
         return None
+    worker["tenants"].add(bot["script_name"])
+    bot["state"] = "running"
+    bot["started_at"] = time.time()
+    registry_save(bot)
+    return worker["process"].pid
+
+async def _stop_tenant(bot):
+    worker = tenant_workers[bot["worker"]]
+    worker["tenants"].discard(bot["script_name"])
+    try:
+        await _tenant_call(worker, {"op": "stop", "name": bot["script_name"]})
+    except Exception as e:
+        print(f"Error stopping tenant {bot['script_name']}: {e}")
+    bot["state"] = "stopped"
+
+async def stop_tenant_workers():
+    workers = list(tenant_workers)
+    tenant_workers.clear()
+    for worker in workers:
+        if worker["process"].returncode is None:
+            worker["process"].terminate()
+            await worker["process"].wait()
+
+# --- Webhook Gateway ---
+async def read_http_request(reader, max_body=WEBHOOK_MAX_BODY):
+    """Reads one HTTP/1.1 request; returns (method, path, headers, body) or None at EOF."""
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None
+    method, path, _ = request_line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        key, _, value = line.decode('latin-1').partition(':')
+        headers[key.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", 0))
+    if length > max_body:
+        raise ValueError("request body too large")
+    body = await reader.readexactly(length) if length else b""
+    return method, path, headers, body
+
+def write_http_response(writer, status, body=b"", content_type="text/plain", extra_headers=()):
+    reason = {200: "OK", 403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed",
+              413: "Payload Too Large", 503: "Service Unavailable"}.get(status, "OK")
+    head = [f"HTTP/1.1 {status} {reason}", f"Content-Type: {content_type}", f"Content-Length: {len(body)}"]
+    head.extend(extra_headers)
+    writer.write(("\r\n".join(head) + "\r\n\r\n").encode() + body)
+
+def _new_route(name, deliver_to, secret=None):
+    secret = secret or secrets.token_urlsafe(24)
+    route = {"name": name, "secret": secret, "queue": asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE),
+             "deliver_to": deliver_to, "received": 0, "rejected": 0, "last_update": None}
+    route["task"] = asyncio.create_task(_deliver_updates(route))
+    webhook_routes[secret] = route
+    return route
+
+def webhook_url(route):
+    return f"{WEBHOOK_PUBLIC_URL.rstrip('/')}/hook/{route['secret']}"
+
+def uses_host_webhook(script_path, main_file):
+    """Hosted bots opt in to gateway delivery by reading HOST_WEBHOOK_SOCKET."""
+    try:
+        with open(os.path.join(script_path, main_file), 'r') as f:
+            return "HOST_WEBHOOK_SOCKET" in f.read()
+    except OSError:
+        return False
+
+def register_bot_route(script_name, secret=None):
+    """Creates the gateway route for a hosted bot and returns the environment it needs.
+
+    The bot is expected to call application.run_webhook(unix=HOST_WEBHOOK_SOCKET,
+    secret_token=HOST_WEBHOOK_SECRET, webhook_url=HOST_WEBHOOK_URL). Pass the bot's
+    previous secret to keep its URL, which a running or relaunched bot has already
+    registered with Telegram.
+    """
+    os.makedirs(WEBHOOK_SOCKETS_DIR, exist_ok=True)
+    socket_path = os.path.abspath(os.path.join(WEBHOOK_SOCKETS_DIR, f"{script_name}.sock"))
+    route = find_bot_route(script_name)
+    if route is None or route["secret"] != secret:
+        unregister_bot_route(script_name)
+        route = _new_route(script_name, socket_path, secret)
+    return {"HOST_WEBHOOK_SOCKET": socket_path, "HOST_WEBHOOK_SECRET": route["secret"],
+            "HOST_WEBHOOK_URL": webhook_url(route)}
+
+def unregister_bot_route(script_name):
+    for secret, route in list(webhook_routes.items()):
+        if route["name"] == script_name:
+            route["task"].cancel()
+            del webhook_routes[secret]
+
+def find_bot_route(script_name):
+    for route in webhook_routes.values():
+        if route["name"] == script_name:
+            return route
+    return None
+
+async def _post_unix(socket_path, secret, body):
+    """Forwards one update to the bot's webhook server on its Unix socket; returns the HTTP status."""
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+    try:
+        return await asyncio.wait_for(_post_unix_request(reader, writer, secret, body), WEBHOOK_DELIVERY_TIMEOUT)
+    finally:
+        writer.close()
+
+async def _post_unix_request(reader, writer, secret, body):
+    writer.write((f"POST / HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+                  f"X-Telegram-Bot-Api-Secret-Token: {secret}\r\n"
+                  f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n").encode() + body)
+    await writer.drain()
+    status_line = await reader.readline()
+    return int(status_line.split()[1])
+
+async def _deliver_updates(route):
+    """Delivers queued updates for one route in order, retrying while the bot is not listening."""
+    while True:
+        body = await route["queue"].get()
+        while True:
+            try:
+                if callable(route["deliver_to"]):
+                    await route["deliver_to"](body)
+                    break
+                status = await _post_unix(route["deliver_to"], route["secret"], body)
+                if status < 500:
+                    break
+            except (OSError, ValueError, IndexError):
+                pass
+            except Exception as e:
+                print(f"Error delivering update to {route['name']}: {e}")
+                break
+            await asyncio.sleep(WEBHOOK_RETRY_DELAY)
+
+async def _handle_ingress(reader, writer):
+    try:
+        while True:
+            try:
+                request = await read_http_request(reader)
+            except ValueError:
+                write_http_response(writer, 413)
+                break
+            if request is None:
+                break
+            method, path, headers, body = request
+            route = webhook_routes.get(path.rstrip('/').rsplit('/', 1)[-1]) if path.startswith("/hook/") else None
+            if route is None:
+                write_http_response(writer, 404)
+            elif method != "POST":
+                write_http_response(writer, 405)
+            elif headers.get("x-telegram-bot-api-secret-token") != route["secret"]:
+                write_http_response(writer, 403)
+            else:
+                try:
+                    route["queue"].put_nowait(body)
+                    route["received"] += 1
+                    route["last_update"] = time.monotonic()
+                    wake_on_traffic(route["name"])
+                    write_http_response(writer, 200)
+                except asyncio.QueueFull:
+                    # Telegram retries failed deliveries, which gives us backpressure for free.
+                    route["rejected"] += 1
+                    write_http_response(writer, 503, extra_headers=["Retry-After: 1"])
+            await writer.drain()
+            if headers.get("connection", "").lower() == "close":
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def serve_webhook(application):
+    """Runs the host bot behind the ingress gateway instead of polling."""
+    async def deliver_to_host(body):
+        await application.update_queue.put(Update.de_json(json.loads(body), application.bot))
+
+    await application.initialize()
+    try:
+        await on_startup(application)
+        await application.start()
+        route = _new_route("host", deliver_to_host)
+        server = await asyncio.start_server(_handle_ingress, WEBHOOK_LISTEN, WEBHOOK_PORT)
+        await application.bot.set_webhook(webhook_url(route), secret_token=route["secret"],
+                                          allowed_updates=Update.ALL_TYPES)
+        print(f"Webhook gateway listening on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}")
+        async with server:
+            await server.serve_forever()
+    finally:
+        if application.running:
+            await application.stop()
+        await on_shutdown(application)
+        await application.shutdown()
+
+async def run_script(user_id, script_name, script_path, main_file, bot_token=None, bot_token_env_name="BOT_TOKEN", python_executable=DEFAULT_PYTHON, adopt_pid=None):
+    """Runs the user's Python script under the supervisor with the given interpreter,
+    or on one of the WORKER_AGENTS when they are configured.
+
+    With adopt_pid, supervises that already running process instead of starting one.
+    Returns the PID of the first launch, or None if it could not be started.
+    """
+    env = child_environment()
+    if bot_token:
+        env[bot_token_env_name] = bot_token
+    if WEBHOOK_ENABLED and not WORKER_AGENTS and uses_host_webhook(script_path, main_file):
+        known = _bot_record(user_id, script_name) or {}
+        env.update(register_bot_route(script_name, known.get("webhook_secret") or registry_webhook_secret(script_name)))
+
+    if user_id not in user_scripts:
+        user_scripts[user_id] = {}
+    bot = user_scripts[user_id].setdefault(script_name, {})
+    bot.update({
+        "user_id": user_id,
+        "script_name": script_name,
+        "path": script_path,
+        "main_file": main_file,
+        "python": python_executable,
+        "env": env,
+        "env_name": bot_token_env_name,
+        "bot_token": bot_token,
+        "state": "starting",
+        "restarts": 0,
+        "stop_reason": None,
+        "webhook_secret": env.get("HOST_WEBHOOK_SECRET"),
+    })
+    if WORKER_AGENTS:
+        return await _run_remote(bot)
+    token = tenant_token(script_path, main_file, python_executable, bot_token)
+    if token:
+        return await _start_tenant(bot, token)
+    launched = asyncio.get_running_loop().create_future()
+    bot["supervisor"] = asyncio.create_task(_supervise_bot(bot, launched, adopt_pid))
+    return await launched
+
+async def _stop_process(process):
+    """SIGTERM to the process's session, then SIGKILL if it is still alive after STOP_TIMEOUT."""
+    if process is None or process.returncode is not None:
+        return
+    _signal_group(process.pid, signal.SIGTERM)
+    _signal_group(process.pid, signal.SIGCONT)  # A hibernated (frozen) bot only sees SIGTERM once resumed
+    try:
+        await asyncio.wait_for(asyncio.shield(process.wait()), STOP_TIMEOUT)
+    except asyncio.TimeoutError:
+        _signal_group(process.pid, signal.SIGKILL)
+        await process.wait()
+
+async def terminate_bot(bot):
+    """Stops the bot's process and its supervisor but keeps the record."""
+    if bot.get("mode") == "tenant":
+        await _stop_tenant(bot)
+        return
+    if bot.get("mode") == "remote":
+        bot["state"] = "stopping"
+        try:
+            # The host keeps the files and re-ships them on the next launch.
+            await agent_call(bot["node"], {"op": "remove", "name": bot["script_name"]})
+        except Exception as e:
+            print(f"Error stopping {bot['script_name']} on {bot['node']}: {e}")
+        bot["state"] = "stopped"
+        return
+    bot["state"] = "stopping"
+    supervisor = bot.get("supervisor")
+    await _stop_process(bot.get("handle"))
+    if supervisor is not None and not supervisor.done():
+        supervisor.cancel()  # Interrupts a pending backoff sleep
+        await asyncio.gather(supervisor, return_exceptions=True)
+    process = bot.get("handle")
+    if process is not None and process.returncode is None:
+        # The stop raced with a (re)launch that was still in flight.
+        _signal_group(process.pid, signal.SIGKILL)
+        await process.wait()
+    bot["state"] = "stopped"
+    running_processes.pop(bot.get("process"), None)
+
+async def restart_script(bot, python_executable=None, overlap=False):
+    """Restarts the bot with its current settings, optionally switching interpreter.
+
+    With overlap, the new process is started before the old one is stopped, which
+    keeps downtime minimal for bots that tolerate two instances briefly (e.g. webhook
+    bots; two long-polling instances make Telegram answer 409 until the old one exits).
+    Returns the new PID or None.
+    """
+    python_executable = python_executable or bot["python"]
+    args = (bot["user_id"], bot["script_name"], bot["path"], bot["main_file"])
+    kwargs = {"bot_token": bot.get("bot_token"), "bot_token_env_name": bot.get("env_name", "BOT_TOKEN"),
+              "python_executable": python_executable}
+    if not overlap or bot.get("mode") in ("tenant", "remote"):
+        await terminate_bot(bot)
+        return await run_script(*args, **kwargs)
+
+    supervisor, old_process = bot.get("supervisor"), bot.get("handle")
+    if supervisor is not None and not supervisor.done():
+        supervisor.cancel()  # Detach the old process so its exit is not treated as a crash
+        await asyncio.gather(supervisor, return_exceptions=True)
+    pid = await run_script(*args, **kwargs)
+    if old_process is not None:
+        running_processes.pop(old_process.pid, None)
+        await _stop_process(old_process)
+    return pid
 
 async def stop_script(user_id, script_name):
-    """Stops a running script for a user."""
-    if user_id in user_scripts and script_name in user_scripts[user_id] and "process" in user_scripts[user_id][script_name]:
-        process_id = user_scripts[user_id][script_name]["process"]
+    """Stops a running script for a user and forgets it."""
+    bot = _bot_record(user_id, script_name)
+    if bot is None:
+        return False
+    try:
+        await terminate_bot(bot)
+        registry_delete(script_name)
+        unregister_bot_route(script_name)
+        bot_stats.pop(script_name, None)
+        del user_scripts[user_id][script_name]
+        return True
+    except Exception as e:
+        print(f"Error stopping script: {e}")
+        return False
+
+# --- Resource Sampler ---
+def read_process_sample(pid):
+    """Reads CPU ticks, RSS, open FDs and I/O bytes of pid from /proc, or returns None if it is gone."""
+    try:
+        with open(f"/proc/{pid}/stat", 'r') as f:
+            stat_line = f.read()
+        with open(f"/proc/{pid}/statm", 'r') as f:
+            rss_pages = int(f.read().split()[1])
+        fds = len(os.listdir(f"/proc/{pid}/fd"))
+    except (OSError, ValueError, IndexError):
+        return None
+    fields = stat_line[stat_line.rindex(')') + 2:].split()
+    sample = {
+        "ticks": int(fields[11]) + int(fields[12]),  # utime + stime
+        "rss": rss_pages * PAGE_SIZE,
+        "fds": fds,
+        "pss": 0,
+        "private": 0,
+        "read_bytes": 0,
+        "write_bytes": 0,
+    }
+    try:
+        # Proportional and private memory show what copy-on-write sharing (zygote mode) saves.
+        with open(f"/proc/{pid}/smaps_rollup", 'r') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key == "Pss":
+                    sample["pss"] = int(value.split()[0]) * 1024
+                elif key in ("Private_Clean", "Private_Dirty"):
+                    sample["private"] += int(value.split()[0]) * 1024
+    except OSError:
+        pass
+    try:
+        with open(f"/proc/{pid}/io", 'r') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in ("read_bytes", "write_bytes"):
+                    sample[key] = int(value)
+    except OSError:
+        pass  # /proc/<pid>/io needs ptrace access on some kernels
+    return sample
+
+def read_samples(pids):
+    return {pid: read_process_sample(pid) for pid in pids}
+
+def _record_sample(bot, sample, now):
+    """Appends one point to the bot's time series and returns it."""
+    stats = bot_stats.setdefault(bot["script_name"], {
+        "series": deque(maxlen=STATS_HISTORY), "pid": None, "ticks": 0, "time": now,
+        "cpu_over": 0, "rss_over": 0, "throttled": False,
+    })
+    cpu = 0.0
+    if stats["pid"] == bot["process"] and now > stats["time"]:
+        cpu = 100.0 * (sample["ticks"] - stats["ticks"]) / CLOCK_TICKS / (now - stats["time"])
+    stats.update(pid=bot["process"], ticks=sample["ticks"], time=now)
+    point = {"time": now, "cpu": cpu, "rss": sample["rss"], "pss": sample["pss"],
+             "private": sample["private"], "fds": sample["fds"],
+             "read_bytes": sample["read_bytes"], "write_bytes": sample["write_bytes"]}
+    stats["series"].append(point)
+    return stats, point
+
+async def _enforce_limits(bot, stats, point):
+    """Throttles bots that hog the CPU and stops bots that stay above their CPU or memory ceiling."""
+    stats["rss_over"] = stats["rss_over"] + 1 if point["rss"] > BOT_MAX_RSS_MB * 1024 ** 2 else 0
+    stats["cpu_over"] = stats["cpu_over"] + 1 if point["cpu"] > BOT_MAX_CPU_PERCENT else 0
+
+    reason = None
+    if stats["rss_over"] >= RSS_STOP_SAMPLES:
+        reason = f"memory above {BOT_MAX_RSS_MB} MB"
+    elif stats["cpu_over"] >= CPU_STOP_SAMPLES:
+        reason = f"CPU above {BOT_MAX_CPU_PERCENT}% for {stats['cpu_over']} samples"
+    elif stats["cpu_over"] >= CPU_THROTTLE_SAMPLES and not stats["throttled"]:
         try:
-            process = await asyncio.create_subprocess_exec("kill", "-9", str(process_id))
-            await process.wait()
-            if process_id in running_processes:
-                del running_processes[process_id]
-            del user_scripts[user_id][script_name]
-            return True
+            os.setpriority(os.PRIO_PGRP, bot["process"], 19)
+            stats["throttled"] = True
+            record_log_line(bot["script_name"], f"throttled: CPU above {BOT_MAX_CPU_PERCENT}%")
+        except OSError as e:
+            print(f"Error throttling {bot['script_name']}: {e}")
+
+    if reason:
+        print(f"Stopping {bot['script_name']}: {reason}")
+        record_log_line(bot["script_name"], f"stopped by resource limits: {reason}")
+        registry_mark_stopped(bot, reason)
+        # Stopping can take up to STOP_TIMEOUT; the sampler moves on to the other bots meanwhile.
+        task = asyncio.create_task(terminate_bot(bot))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+async def resource_sampler():
+    """Samples every supervised bot from /proc in one pass every STATS_INTERVAL seconds."""
+    while True:
+        await asyncio.sleep(STATS_INTERVAL)
+        try:
+            bots = [bot for scripts in user_scripts.values() for bot in scripts.values()
+                    if bot.get("state") == "running" and bot.get("process")]
+            samples = await asyncio.to_thread(read_samples, [bot["process"] for bot in bots])
+            now = time.monotonic()
+            for bot in bots:
+                sample = samples.get(bot["process"])
+                if sample is None or bot.get("state") != "running":
+                    continue
+                stats, point = _record_sample(bot, sample, now)
+                if point["cpu"] > IDLE_CPU_PERCENT:
+                    bot["last_active"] = now
+                await _enforce_limits(bot, stats, point)
         except Exception as e:
-            print(f"Error stopping script: {e}")
-            return False
+            print(f"Error sampling bot resources: {e}")
+
+def summarize_stats(script_name):
+    """Returns the latest point plus average/peak CPU and peak RSS over the kept series, or None."""
+    stats = bot_stats.get(script_name)
+    if not stats or not stats["series"]:
+        return None
+    series = stats["series"]
+    return {
+        "latest": series[-1],
+        "cpu_avg": sum(point["cpu"] for point in series) / len(series),
+        "cpu_max": max(point["cpu"] for point in series),
+        "rss_max": max(point["rss"] for point in series),
+        "throttled": stats["throttled"],
+    }
+
+# --- Idle Hibernation ---
+def _find_bot(script_name):
+    for scripts in user_scripts.values():
+        if script_name in scripts:
+            return scripts[script_name]
+    return None
+
+def _peek_token(bot):
+    """Token to peek for pending updates: the one we injected, or a literal in the main file."""
+    if bot.get("bot_token"):
+        return bot["bot_token"]
+    try:
+        with open(os.path.join(bot["path"], bot["main_file"]), 'r') as f:
+            match = re.search(BOT_TOKEN_REGEX, f.read(), re.IGNORECASE)
+    except OSError:
+        return None
+    return match.group(2) if match else None
+
+async def has_pending_updates(client, token):
+    """Checks for unconfirmed updates without consuming them (no offset, no long poll).
+
+    Returns None when Telegram cannot tell us, e.g. a webhook is set or another
+    getUpdates call conflicts.
+    """
+    try:
+        response = await client.post(f"{TELEGRAM_API_BASE}{token}/getUpdates", data={"limit": 1, "timeout": 0})
+        reply = response.json()
+    except Exception as e:
+        print(f"Error peeking updates: {e}")
+        return None
+    if not reply.get("ok"):
+        return None
+    return bool(reply["result"])
+
+async def hibernate_bot(bot):
+    """Freezes or stops an idle bot according to HIBERNATE_MODE."""
+    if HIBERNATE_MODE == "freeze":
+        if not _signal_group(bot["process"], signal.SIGSTOP):
+            return
+    else:
+        await terminate_bot(bot)
+    bot["state"] = "hibernated"
+    bot["hibernation"] = HIBERNATE_MODE
+    bot["hibernated_at"] = time.monotonic()
+    record_log_line(bot["script_name"], f"hibernated ({HIBERNATE_MODE}) after {IDLE_TIMEOUT}s idle")
+    log_event("bot_hibernated", bot=bot["script_name"], mode=HIBERNATE_MODE)
+
+async def wake_bot(bot, reason, client=None, token=None):
+    """Resumes a hibernated bot and records how long it took.
+
+    wake_seconds covers signalling or relaunching the bot; when a peek client and token
+    are given, wake_to_consume_seconds also covers the time until the bot has taken its
+    pending update, which is the delay the user actually sees.
+    """
+    if bot.get("state") != "hibernated":
+        return
+    bot["state"] = "waking"
+    started = time.perf_counter()
+    mode = bot.get("hibernation", HIBERNATE_MODE)
+    if mode == "freeze":
+        _signal_group(bot["process"], signal.SIGCONT)
+        bot["state"] = "running"
+    elif not await run_script(bot["user_id"], bot["script_name"], bot["path"], bot["main_file"],
+                              bot_token=bot.get("bot_token"), bot_token_env_name=bot.get("env_name", "BOT_TOKEN"),
+                              python_executable=bot["python"]):
+        return
+    bot["last_active"] = time.monotonic()
+    resumed = time.perf_counter() - started
+    bot["last_wake_seconds"] = resumed
+    observe("wake_seconds", resumed, mode=mode)
+    record_log_line(bot["script_name"], f"woken by {reason} in {resumed:.3f}s")
+    log_event("bot_woken", bot=bot["script_name"], mode=mode, reason=reason, seconds=round(resumed, 4))
+
+    if client is not None and token:
+        deadline = time.monotonic() + WAKE_CONSUME_TIMEOUT
+        while time.monotonic() < deadline:
+            await asyncio.sleep(0.5)
+            if await has_pending_updates(client, token) is False:
+                consumed = time.perf_counter() - started
+                bot["last_wake_seconds"] = consumed
+                observe("wake_to_consume_seconds", consumed, mode=mode)
+                break
+
+def wake_on_traffic(script_name):
+    """Called by the webhook gateway: incoming traffic wakes a hibernated bot right away."""
+    bot = _find_bot(script_name)
+    if bot is not None and bot.get("state") == "hibernated":
+        task = asyncio.create_task(wake_bot(bot, "webhook"))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+async def _wakeable_when_idle(bot, client):
+    """True if traffic for an idle bot would wake it again: it sits behind the webhook gateway,
+    or a peek at its token just showed an empty queue. Bots without a token we can peek, or
+    with their own webhook (getUpdates fails), are left running.
+    """
+    if find_bot_route(bot["script_name"]):
+        return True
+    token = _peek_token(bot)
+    return bool(token) and await has_pending_updates(client, token) is False
+
+async def hibernation_manager():
+    """Hibernates idle bots and wakes hibernated ones that have pending updates."""
+    import httpx  # Dependency of python-telegram-bot
+    async with httpx.AsyncClient(timeout=10) as client:
+        while True:
+            await asyncio.sleep(WAKE_POLL_INTERVAL)
+            try:
+                now = time.monotonic()
+                for scripts in list(user_scripts.values()):
+                    for bot in list(scripts.values()):
+                        if bot.get("mode") in ("tenant", "remote"):
+                            continue
+                        if bot.get("state") == "running" and now - bot.get("last_active", now) > IDLE_TIMEOUT:
+                            if await _wakeable_when_idle(bot, client):
+                                await hibernate_bot(bot)
+                            else:
+                                bot["last_active"] = now  # Check again after another idle period
+                        elif bot.get("state") == "hibernated" and not find_bot_route(bot["script_name"]):
+                            token = _peek_token(bot)
+                            if token and await has_pending_updates(client, token):
+                                task = asyncio.create_task(wake_bot(bot, "pending updates", client, token))
+                                background_tasks.add(task)
+                                task.add_done_callback(background_tasks.discard)
+            except Exception as e:
+                print(f"Error in hibernation manager: {e}")
+
+# --- Worker Agents ---
+def read_secret_file(path):
+    """Returns the secret stored in path, refusing files that other users can read."""
+    with open(path, 'r') as f:
+        if os.fstat(f.fileno()).st_mode & 0o077:
+            raise PermissionError(f"{path} must not be readable by group or others (chmod 600)")
+        secret = f.read().strip()
+    if not secret:
+        raise ValueError(f"{path} is empty")
+    return secret
+
+def load_agent_secret():
+    global agent_secret
+    agent_secret = read_secret_file(AGENT_SECRET_FILE)
+
+def _agent(address):
+    return worker_agents.setdefault(address, {"status": None, "failures": 0, "draining": False,
+                                              "reserved_rss": 0, "reserved_cpu": 0.0})
+
+async def agent_call(address, request, timeout=AGENT_TIMEOUT):
+    """Sends one request to a worker agent (see worker_agent.py) and returns its result."""
+    async def call():
+        if address.startswith("unix:"):
+            reader, writer = await asyncio.open_unix_connection(address[len("unix:"):], limit=AGENT_MAX_REPLY)
+        else:
+            host, _, port = address.rpartition(':')
+            reader, writer = await asyncio.open_connection(host, int(port), limit=AGENT_MAX_REPLY)
+        try:
+            writer.write(json.dumps(dict(request, secret=agent_secret)).encode() + b"\n")
+            await writer.drain()
+            line = await reader.readline()
+        finally:
+            writer.close()
+        if not line:
+            raise ConnectionError("agent closed the connection")
+        return json.loads(line)
+
+    reply = await asyncio.wait_for(call(), timeout)
+    if not reply.get("ok"):
+        raise RuntimeError(f"agent {address}: {reply.get('error')}")
+    return reply.get("result")
+
+async def agent_statuses():
+    """Queries every agent at once and refreshes the remote bot records. Unreachable agents map to None."""
+    results = await asyncio.gather(*(agent_call(address, {"op": "status"}) for address in WORKER_AGENTS),
+                                   return_exceptions=True)
+    statuses = {}
+    for address, result in zip(WORKER_AGENTS, results):
+        agent = _agent(address)
+        if isinstance(result, Exception):
+            agent["failures"] += 1
+            agent["status"] = statuses[address] = None
+        else:
+            agent["failures"] = 0
+            agent["status"] = statuses[address] = result
+    _sync_remote_bots(statuses)
+    return statuses
+
+def _sync_remote_bots(statuses):
+    """Copies state, PID and resource use reported by the agents into the host's records."""
+    for scripts in user_scripts.values():
+        for bot in scripts.values():
+            status = statuses.get(bot.get("node")) if bot.get("mode") == "remote" else None
+            if status is None or bot.get("placing") or bot.get("state") in ("starting", "stopping", "stopped"):
+                continue
+            entry = next((entry for entry in status["bots"] if entry["name"] == bot["script_name"]), None)
+            if entry is None:
+                bot["state"] = "lost"  # The agent no longer has it, e.g. its root was wiped
+                continue
+            bot.update({"state": entry["state"], "remote_pid": entry["pid"], "restarts": entry["restarts"],
+                        "remote_stats": {"rss": entry["rss"], "cpu": entry["cpu"]}})
+
+def _estimate_need(statuses):
+    """Expected RSS and CPU of a new bot: the mean of what running bots measure, or the defaults."""
+    measured = [entry for status in statuses.values() if status for entry in status["bots"] if entry["rss"]]
+    if not measured:
+        return BOT_DEFAULT_RSS_MB * 1024 ** 2, BOT_DEFAULT_CPU_PERCENT
+    return (sum(entry["rss"] for entry in measured) / len(measured),
+            max(sum(entry["cpu"] for entry in measured) / len(measured), BOT_DEFAULT_CPU_PERCENT))
+
+def pick_worker(statuses, exclude=()):
+    """Chooses the agent with the most memory headroom (then CPU headroom) left after placing the bot.
+
+    Returns (address, rss, cpu) with the bot's expected footprint; address is None when no
+    reachable, non-draining agent has room for it.
+    """
+    need_rss, need_cpu = _estimate_need(statuses)
+    best, best_key = None, None
+    for address, status in statuses.items():
+        agent = _agent(address)
+        if status is None or agent["draining"] or address in exclude:
+            continue
+        free_rss = (status["mem_available"] - agent["reserved_rss"]
+                    - PLACEMENT_RESERVE_MB * 1024 ** 2 - need_rss)
+        free_cpu = (status["cpus"] * 100 - sum(entry["cpu"] for entry in status["bots"])
+                    - agent["reserved_cpu"] - need_cpu)
+        if free_rss < 0 or free_cpu < 0:
+            continue
+        key = (free_rss, free_cpu)
+        if best_key is None or key > best_key:
+            best, best_key = address, key
+    return best, need_rss, need_cpu
+
+def pack_directory(path):
+    """Zips a bot's directory in memory and returns it base64-encoded for a launch request."""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for root, dirs, files in os.walk(path):
+            dirs[:] = [name for name in dirs if name != "__pycache__"]
+            for name in files:
+                full_path = os.path.join(root, name)
+                archive.write(full_path, os.path.relpath(full_path, path))
+    return base64.b64encode(buffer.getvalue()).decode()
+
+async def _run_remote(bot, adopt=True, exclude=()):
+    """Places the bot on a worker agent and launches it there. Returns the remote PID or None.
+
+    With adopt, a bot of the same name that an agent already runs (e.g. after a host
+    restart) is taken over instead of being launched again.
+    """
+    name = bot["script_name"]
+    statuses = await agent_statuses()
+    if adopt:
+        for address, status in statuses.items():
+            entry = next((entry for entry in status["bots"] if entry["name"] == name), None) if status else None
+            if entry is not None and entry["state"] != "stopped":
+                bot.update({"mode": "remote", "node": address, "remote_pid": entry["pid"], "process": None,
+                            "state": entry["state"], "started_at": time.time()})
+                registry_save(bot)
+                return entry["pid"]
+
+    address, need_rss, need_cpu = pick_worker(statuses, exclude)
+    if address is None:
+        print(f"No worker agent has room for {name}")
+        return None
+    agent = _agent(address)
+    agent["reserved_rss"] += need_rss
+    agent["reserved_cpu"] += need_cpu
+    bot["placing"] = address
+    try:
+        archive = await run_in_deploy_pool(pack_directory, bot["path"])
+        result = await agent_call(address, {
+            "op": "launch", "name": name, "user_id": bot["user_id"], "main_file": bot["main_file"],
+            "archive": archive, "bot_token": bot.get("bot_token"), "env_name": bot.get("env_name", "BOT_TOKEN"),
+        }, AGENT_LAUNCH_TIMEOUT)
+    except Exception as e:
+        print(f"Error launching {name} on {address}: {e}")
+        return None
+    finally:
+        agent["reserved_rss"] -= need_rss
+        agent["reserved_cpu"] -= need_cpu
+        bot.pop("placing", None)
+    bot.update({"mode": "remote", "node": address, "remote_pid": result["pid"], "process": None,
+                "state": "running", "started_at": time.time()})
+    registry_save(bot)
+    increment("bots_placed_total", node=address)
+    log_event("bot_placed", bot=name, node=address, pid=result["pid"])
+    return result["pid"]
+
+async def evacuate_worker(address, reachable=True):
+    """Moves every bot off the agent, starting each elsewhere before removing the old copy.
+
+    Bots that fit nowhere keep running where they are; if the agent is unreachable they are
+    marked lost and agent_monitor() keeps trying to place them. Returns (moved, failed).
+    """
+    moved = failed = 0
+    bots = [bot for scripts in user_scripts.values() for bot in scripts.values()
+            if bot.get("mode") == "remote" and bot.get("node") == address and bot.get("state") not in ("stopped", "lost")]
+    for bot in bots:
+        if await _run_remote(bot, adopt=False, exclude=(address,)):
+            moved += 1
+            if reachable:
+                try:
+                    await agent_call(address, {"op": "remove", "name": bot["script_name"]})
+                except Exception as e:
+                    print(f"Error removing {bot['script_name']} from {address}: {e}")
+        else:
+            failed += 1
+            if not reachable:
+                bot["state"] = "lost"
+    log_event("worker_evacuated", node=address, moved=moved, failed=failed)
+    return moved, failed
+
+async def agent_monitor():
+    """Keeps remote bot states fresh, fails over bots of agents that stopped answering,
+    re-places lost bots and removes copies an agent runs that the host has placed elsewhere."""
+    while True:
+        await asyncio.sleep(AGENT_CHECK_INTERVAL)
+        try:
+            statuses = await agent_statuses()
+            for address, status in statuses.items():
+                if status is None:
+                    if _agent(address)["failures"] >= AGENT_FAILOVER_CHECKS:
+                        await evacuate_worker(address, reachable=False)
+                    continue
+                for entry in status["bots"]:
+                    bot = _find_bot(entry["name"])
+                    if bot is None or (bot.get("node") != address and bot.get("placing") != address):
+                        await agent_call(address, {"op": "remove", "name": entry["name"]})
+            for scripts in list(user_scripts.values()):
+                for bot in list(scripts.values()):
+                    if bot.get("mode") == "remote" and bot.get("state") == "lost" and await _run_remote(bot):
+                        record_log_line(bot["script_name"], f"re-placed on {bot['node']}")
+        except Exception as e:
+            print(f"Error checking worker agents: {e}")
+
+async def bot_log_lines(bot, lines):
+    """Recent output of the bot, fetched from its worker agent when it runs remotely."""
+    if bot.get("mode") != "remote":
+        return await recent_log_lines(bot["script_name"], lines)
+    try:
+        return await agent_call(bot["node"], {"op": "logs", "name": bot["script_name"], "lines": lines})
+    except Exception as e:
+        return [f"(logs unavailable from {bot['node']}: {e})"]
+
+# --- Deploy Pipeline ---
+async def run_in_deploy_pool(func, *args):
+    """Runs blocking deploy work in the bounded thread pool so the event loop stays responsive."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(deploy_executor, functools.partial(func, *args))
+
+def remove_path(path):
+    """Removes a file or directory tree, ignoring anything that is already gone."""
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def extract_archive(zip_path, dest, progress):
+    """Extracts zip_path into dest member by member, aborting as soon as a limit is exceeded.
+
+    Sizes are counted from the bytes actually written rather than trusted from the
+    archive headers. progress is a dict updated in place for the reporting task.
+    """
+    dest_root = os.path.realpath(dest)
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        members = zip_ref.infolist()
+        if len(members) > MAX_ARCHIVE_FILES:
+            raise ArchiveRejected(f"archive has more than {MAX_ARCHIVE_FILES} files")
+        if sum(info.file_size for info in members) > MAX_ARCHIVE_BYTES:
+            raise ArchiveRejected(f"archive expands to more than {MAX_ARCHIVE_BYTES // 1024 ** 2} MB")
+        progress["files_total"] = len(members)
+
+        for info in members:
+            target = os.path.realpath(os.path.join(dest_root, info.filename))
+            if target != dest_root and not target.startswith(dest_root + os.sep):
+                raise ArchiveRejected(f"unsafe path in archive: {info.filename}")
+            if info.is_dir():
+                os.makedirs(target, exist_ok=True)
+                progress["files_done"] += 1
+                continue
+
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            written = 0
+            with zip_ref.open(info) as src, open(target, 'wb') as dst:
+                while True:
+                    chunk = src.read(EXTRACT_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    written += len(chunk)
+                    progress["bytes_done"] += len(chunk)
+                    if progress["bytes_done"] > MAX_ARCHIVE_BYTES:
+                        raise ArchiveRejected(f"archive expands to more than {MAX_ARCHIVE_BYTES // 1024 ** 2} MB")
+                    if written > EXTRACT_CHUNK_SIZE and written > MAX_COMPRESSION_RATIO * max(info.compress_size, 1):
+                        raise ArchiveRejected(f"suspicious compression ratio for {info.filename}")
+                    dst.write(chunk)
+            progress["files_done"] += 1
+
+async def report_progress(message, progress):
+    """Edits message with extraction progress until cancelled."""
+    last_text = None
+    while True:
+        await asyncio.sleep(PROGRESS_INTERVAL)
+        text = (f"📦 Extracting... {progress['files_done']}/{progress['files_total']} files, "
+                f"{progress['bytes_done'] / 1024 ** 2:.1f} MB")
+        if text != last_text:
+            try:
+                await message.edit_text(text)
+                last_text = text
+            except Exception as e:
+                print(f"Error updating progress message: {e}")
+
+async def set_status(message, text):
+    """Edits a deploy status message; a failed edit (flood control, network) must not fail the deploy."""
+    try:
+        await message.edit_text(text)
+    except Exception as e:
+        print(f"Error updating status message: {e}")
+
+async def deploy_archive(zip_path, script_path, status_message):
+    """Extracts the uploaded archive in the deploy pool while reporting progress, then deletes it."""
+    progress = {"files_done": 0, "files_total": 0, "bytes_done": 0}
+    reporter = asyncio.create_task(report_progress(status_message, progress))
+    try:
+        await run_in_deploy_pool(os.makedirs, script_path, 0o777, True)
+        await run_in_deploy_pool(extract_archive, zip_path, script_path, progress)
+    finally:
+        reporter.cancel()
+        await run_in_deploy_pool(remove_path, zip_path)
+
+# --- Deploy Job Scheduler ---
+def start_deploy_workers():
+    """Creates the stage semaphores and starts DEPLOY_JOB_WORKERS workers on the running loop."""
+    global deploy_queue_ready
+    deploy_queue_ready = asyncio.Condition()
+    stage_limits.update(
+        extract=asyncio.Semaphore(EXTRACT_CONCURRENCY),
+        install=asyncio.Semaphore(INSTALL_CONCURRENCY),
+        launch=asyncio.Semaphore(LAUNCH_CONCURRENCY),
+    )
+    for _ in range(DEPLOY_JOB_WORKERS):
+        task = asyncio.create_task(_deploy_worker())
+        background_tasks.add(task)
+
+def deploy_stage(stage):
+    """Limits how many deploys run the given stage (extract, install, launch) at once."""
+    return stage_limits[stage]
+
+async def launch_script(*args, **kwargs):
+    """run_script() behind the launch stage limit."""
+    async with deploy_stage("launch"):
+        with deploy_timer("launch"):
+            return await run_script(*args, **kwargs)
+
+def submit_deploy_job(user_id, name, work):
+    """Queues work (a coroutine function) behind the user's earlier jobs and returns the job."""
+    job = {"user_id": user_id, "name": name, "work": work, "state": "queued",
+           "future": asyncio.get_running_loop().create_future(), "task": None}
+    deploy_queues.setdefault(user_id, deque()).append(job)
+    task = asyncio.create_task(_notify_deploy_workers())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return job
+
+async def _notify_deploy_workers():
+    async with deploy_queue_ready:
+        deploy_queue_ready.notify()
+
+def _next_deploy_job():
+    """Takes the next job round-robin: one job from the first user in line, who then moves to the back."""
+    user_id, jobs = next(iter(deploy_queues.items()))
+    job = jobs.popleft()
+    del deploy_queues[user_id]
+    if jobs:
+        deploy_queues[user_id] = jobs
+    return job
+
+def deploy_queue_position(job):
+    """1-based position of a queued job under round-robin order, or 0 if it is no longer queued."""
+    jobs = deploy_queues.get(job["user_id"])
+    if job["state"] != "queued" or not jobs or job not in jobs:
+        return 0
+    index = jobs.index(job)
+    position = index + 1
+    before = True
+    for user_id, other in deploy_queues.items():
+        if user_id == job["user_id"]:
+            before = False
+            continue
+        position += min(len(other), index + 1 if before else index)
+    return position
+
+async def _deploy_worker():
+    while True:
+        async with deploy_queue_ready:
+            await deploy_queue_ready.wait_for(lambda: bool(deploy_queues))
+            job = _next_deploy_job()
+        job["state"] = "running"
+        job["task"] = asyncio.create_task(job["work"]())
+        try:
+            # asyncio.wait does not pass our own cancellation on, so it can be told apart from the job's.
+            await asyncio.wait([job["task"]])
+        except asyncio.CancelledError:
+            job["task"].cancel()
+            job["future"].cancel()
+            job["state"] = "cancelled"
+            raise
+        try:
+            job["future"].set_result(job["task"].result())
+        except asyncio.CancelledError:
+            job["future"].cancel()
+        except Exception as e:
+            job["future"].set_exception(e)
+        job["state"] = "cancelled" if job["future"].cancelled() else "done"
+
+def cancel_deploy_job(job):
+    """Cancels a queued or running job. Returns False if it had already finished."""
+    if job["state"] == "queued":
+        jobs = deploy_queues.get(job["user_id"])
+        jobs.remove(job)
+        if not jobs:
+            del deploy_queues[job["user_id"]]
+        job["state"] = "cancelled"
+        job["future"].cancel()
+        return True
+    if job["state"] == "running":
+        job["task"].cancel()
+        return True
     return False
 
+async def wait_for_deploy_job(job, status_message):
+    """Waits for the job, keeping status_message updated with its queue position."""
+    last_position = None
+    while not job["future"].done():
+        position = deploy_queue_position(job)
+        if position and position != last_position:
+            try:
+                await status_message.edit_text(
+                    f"⏳ Your deploy is queued (position {position}). Send /cancel to abort.",
+                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Cancel", callback_data='cancel')]])
+                )
+            except Exception as e:
+                print(f"Error updating queue position: {e}")
+            last_position = position
+        await asyncio.wait([job["future"]], timeout=QUEUE_POSITION_INTERVAL)
+    return job["future"].result()
+
+async def prepare_deploy(temp_zip_path, script_path, main_file_name, status_message):
+    """Deploy job: extracts the archive, checks the main file and installs requirements.
+
+    Returns the interpreter to run the bot with, or None if requirements failed to install.
+    """
+    try:
+        async with deploy_stage("extract"):
+            await set_status(status_message, "📦 Extracting your zip file...")
+            with deploy_timer("extract"):
+                await deploy_archive(temp_zip_path, script_path, status_message)
+        if not os.path.exists(os.path.join(script_path, main_file_name)):
+            raise FileNotFoundError(main_file_name)
+        if WORKER_AGENTS:
+            return DEFAULT_PYTHON  # Requirements are installed by the agent the bot is placed on
+        async with deploy_stage("install"):
+            if os.path.exists(os.path.join(script_path, REQUIREMENTS_FILE)):
+                await set_status(status_message, "📚 Installing requirements...")
+            with deploy_timer("install"):
+                return await install_requirements(script_path)
+    except BaseException:
+        await run_in_deploy_pool(remove_path, script_path)
+        raise
+
+# --- Incremental Updates ---
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(EXTRACT_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def diff_trees(staging_path, script_path):
+    """Returns (changed, added): relative paths in staging that differ from, or are missing in, script_path."""
+    changed, added = [], []
+    for root, _, files in os.walk(staging_path):
+        for name in files:
+            relative = os.path.relpath(os.path.join(root, name), staging_path)
+            new_path, current_path = os.path.join(staging_path, relative), os.path.join(script_path, relative)
+            if not os.path.isfile(current_path):
+                added.append(relative)
+            elif (os.path.getsize(new_path) != os.path.getsize(current_path)
+                  or file_digest(new_path) != file_digest(current_path)):
+                changed.append(relative)
+    return sorted(changed), sorted(added)
+
+def apply_update(staging_path, script_path, revision_path, changed, added, previous):
+    """Moves changed and added files into place, keeping the replaced ones in revision_path.
+
+    Files that are absent from the new archive are left alone, since bots keep
+    runtime data (databases, sessions) next to their code.
+    """
+    remove_path(revision_path)
+    os.makedirs(revision_path)
+    for relative in changed:
+        backup = os.path.join(revision_path, "files", relative)
+        os.makedirs(os.path.dirname(backup), exist_ok=True)
+        shutil.copy2(os.path.join(script_path, relative), backup)
+    with open(os.path.join(revision_path, "manifest.json"), 'w') as f:
+        json.dump({"changed": changed, "added": added, "created_at": time.time(), **previous}, f)
+    for relative in changed + added:
+        target = os.path.join(script_path, relative)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(os.path.join(staging_path, relative), target)
+
+def rollback_files(script_path, revision_path):
+    """Restores the files replaced by the last update and removes the ones it added.
+
+    Returns the manifest, or None if there is nothing to roll back.
+    """
+    try:
+        with open(os.path.join(revision_path, "manifest.json"), 'r') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    for relative in manifest["changed"]:
+        os.replace(os.path.join(revision_path, "files", relative), os.path.join(script_path, relative))
+    for relative in manifest["added"]:
+        remove_path(os.path.join(script_path, relative))
+    remove_path(revision_path)
+    return manifest
+
+def _requirements_hash_or_none(script_path):
+    path = os.path.join(script_path, REQUIREMENTS_FILE)
+    if not os.path.exists(path):
+        return None
+    # Requirements on local files may change with any file, so they always count as changed.
+    return requirements_hash(path) or f"local-{time.time_ns()}"
+
+async def prepare_update(bot, zip_path, status_message):
+    """Deploy job for /update: extracts to a staging directory, applies only changed files and
+    reinstalls requirements only when their hash changed.
+
+    Returns (changed, added, python) where python is the interpreter to restart with.
+    """
+    script_path = bot["path"]
+    staging_path = await run_in_deploy_pool(tempfile.mkdtemp, "", ".staging-", SCRIPTS_DIR)
+    try:
+        async with deploy_stage("extract"):
+            await set_status(status_message, "📦 Extracting your update...")
+            with deploy_timer("extract"):
+                await deploy_archive(zip_path, staging_path, status_message)
+        if not os.path.exists(os.path.join(staging_path, bot["main_file"])):
+            raise FileNotFoundError(bot["main_file"])
+
+        old_requirements = await run_in_deploy_pool(_requirements_hash_or_none, script_path)
+        with deploy_timer("diff"):
+            changed, added = await run_in_deploy_pool(diff_trees, staging_path, script_path)
+        if not changed and not added:
+            return changed, added, bot["python"]
+        previous = {"python": bot["python"], "requirements_hash": old_requirements}
+        await run_in_deploy_pool(apply_update, staging_path, script_path,
+                                 os.path.join(REVISIONS_DIR, bot["script_name"]), changed, added, previous)
+    finally:
+        await run_in_deploy_pool(remove_path, staging_path)
+
+    python_executable = bot["python"]
+    if not WORKER_AGENTS and await run_in_deploy_pool(_requirements_hash_or_none, script_path) != old_requirements:
+        async with deploy_stage("install"):
+            await set_status(status_message, "📚 Requirements changed, installing...")
+            with deploy_timer("install"):
+                python_executable = await install_requirements(script_path) or DEFAULT_PYTHON
+    return changed, added, python_executable
+
 # --- Command Handlers ---
 async def start(update: Update, context: CallbackContext):
     """Sends a welcome message and help information with inline keyboard."""
@@ -134,14 +2207,14 @@ async def new_script_start(update: Update, context: CallbackContext):
     if update.message:
         await update.message.reply_text(
             "Okay, let's host a *new bot*! 🚀\nPlease send me a *zip file* containing your Python script and requirements (if any).",
-            parse_mode=telegram.ParseMode.MARKDOWN
+            parse_mode=ParseMode.MARKDOWN
         )
     elif update.callback_query:
         query = update.callback_query
         await query.answer()
         await query.edit_message_text(
             "Okay, let's host a *new bot*! 🚀\nPlease send me a *zip file* containing your Python script and requirements (if any).",
-            parse_mode=telegram.ParseMode.MARKDOWN
+            parse_mode=ParseMode.MARKDOWN
         )
     return NEW_SCRIPT_ZIP
 
@@ -149,22 +2222,26 @@ async def new_script_zip_file(update: Update, context: CallbackContext):
     """Handles the uploaded zip file."""
     zip_file = update.message.document
     if zip_file.mime_type != 'application/zip':
-        await update.message.reply_text("⚠️ Please send a *valid zip file*.", parse_mode=telegram.ParseMode.MARKDOWN)
+        await update.message.reply_text("⚠️ Please send a *valid zip file*.", parse_mode=ParseMode.MARKDOWN)
+        return NEW_SCRIPT_ZIP
+    if zip_file.file_size and zip_file.file_size > MAX_UPLOAD_BYTES:
+        await update.message.reply_text(f"⚠️ Zip file is too large. The limit is *{MAX_UPLOAD_BYTES // 1024 ** 2} MB*.", parse_mode=ParseMode.MARKDOWN)
         return NEW_SCRIPT_ZIP
 
     try:
-        temp_zip_file = tempfile.NamedTemporaryFile(delete=False)
-        context.user_data['temp_zip_path'] = temp_zip_file.name
+        fd, temp_zip_path = tempfile.mkstemp(suffix=".zip")
+        os.close(fd)
+        context.user_data['temp_zip_path'] = temp_zip_path
         file_id = zip_file.file_id
-        new_file = await context.bot.get_file(file_id) # Use context.bot to get file
-        await new_file.download_to_drive(temp_zip_file.name) # Use download_to_drive
-        temp_zip_file.close()
+        with deploy_timer("download"):
+            new_file = await context.bot.get_file(file_id) # Use context.bot to get file
+            await new_file.download_to_drive(temp_zip_path) # Streams to disk without blocking the loop
 
-        await update.message.reply_text("✅ Zip file received! Now, please tell me the name of your *main Python file* (e.g., `main.py`).", parse_mode=telegram.ParseMode.MARKDOWN)
+        await update.message.reply_text("✅ Zip file received! Now, please tell me the name of your *main Python file* (e.g., `main.py`).", parse_mode=ParseMode.MARKDOWN)
         return GET_MAIN_FILE_NAME
     except Exception as e:
         print(f"Error downloading or saving zip file: {e}")
-        await update.message.reply_text("❌ Sorry, there was an error processing your zip file. Please try again.", parse_mode=telegram.ParseMode.MARKDOWN)
+        await update.message.reply_text("❌ Sorry, there was an error processing your zip file. Please try again.", parse_mode=ParseMode.MARKDOWN)
         return ConversationHandler.END
 
 async def new_script_main_file_name(update: Update, context: CallbackContext):
@@ -172,14 +2249,14 @@ async def new_script_main_file_name(update: Update, context: CallbackContext):
     main_file_name = update.message.text.strip()
 
     if not re.search(MAIN_FILE_REGEX, main_file_name):
-        await update.message.reply_text(f"⚠️ Please provide a *valid main file name* (e.g., `main.py`). Currently you provided: `{main_file_name}`", parse_mode=telegram.ParseMode.MARKDOWN)
+        await update.message.reply_text(f"⚠️ Please provide a *valid main file name* (e.g., `main.py`). Currently you provided: `{main_file_name}`", parse_mode=ParseMode.MARKDOWN)
         return GET_MAIN_FILE_NAME
 
     context.user_data['main_file_name'] = main_file_name
     temp_zip_path = context.user_data.get('temp_zip_path')
 
     if not temp_zip_path or not os.path.exists(temp_zip_path):
-        await update.message.reply_text("❌ Error: Zip file not found. Please start the process again with /new.", parse_mode=telegram.ParseMode.MARKDOWN)
+        await update.message.reply_text("❌ Error: Zip file not found. Please start the process again with /new.", parse_mode=ParseMode.MARKDOWN)
         return ConversationHandler.END
 
     script_name = f"bot_{update.message.from_user.id}_{update.message.message_id}"
@@ -187,46 +2264,57 @@ async def new_script_main_file_name(update: Update, context: CallbackContext):
     context.user_data['script_name'] = script_name
 
     try:
-        os.makedirs(script_path, exist_ok=True)
-        with zipfile.ZipFile(temp_zip_path, 'r') as zip_ref:
-            zip_ref.extractall(script_path)
-        os.remove(temp_zip_path)
-
-        if not os.path.exists(os.path.join(script_path, main_file_name)):
-            await update.message.reply_text(f"❌ Error: Main file `{main_file_name}` not found in the zip file. Please check your zip contents and try again.", parse_mode=telegram.ParseMode.MARKDOWN)
-            shutil.rmtree(script_path)
+        status_message = await update.message.reply_text("⏳ Your deploy is queued...")
+        job = submit_deploy_job(update.message.from_user.id, script_name,
+                                lambda: prepare_deploy(temp_zip_path, script_path, main_file_name, status_message))
+        context.user_data['deploy_job'] = job
+        try:
+            python_executable = await wait_for_deploy_job(job, status_message)
+        except (ArchiveRejected, zipfile.BadZipFile) as e:
+            await update.message.reply_text(f"❌ Your zip file was rejected: {e}")
             return ConversationHandler.END
+        except FileNotFoundError:
+            await update.message.reply_text(f"❌ Error: Main file `{main_file_name}` not found in the zip file. Please check your zip contents and try again.", parse_mode=ParseMode.MARKDOWN)
+            return ConversationHandler.END
+        except asyncio.CancelledError:
+            if not job["future"].cancelled():
+                raise
+            return ConversationHandler.END  # Cancelled by the user through new_script_cancel
 
-        if not await install_requirements(script_path): # Await the async function
-            await update.message.reply_text("⚠️ *Warning*: There was an issue installing requirements. The bot might not run correctly if it has dependencies.", parse_mode=telegram.ParseMode.MARKDOWN)
+        if not python_executable:
+            python_executable = DEFAULT_PYTHON
+            await update.message.reply_text("⚠️ *Warning*: There was an issue installing requirements. The bot might not run correctly if it has dependencies.", parse_mode=ParseMode.MARKDOWN)
+        context.user_data['python_executable'] = python_executable
 
         main_file_full_path = os.path.join(script_path, main_file_name)
-        bot_token_var_name = extract_bot_token_variable_name(main_file_full_path)
+        with deploy_timer("token_scan"):
+            bot_token_var_name = extract_bot_token_variable_name(main_file_full_path)
+            with open(main_file_full_path, 'r') as f:
+                content = f.read()
+            has_token = re.search(BOT_TOKEN_REGEX, content, re.IGNORECASE)
         context.user_data['bot_token_var_name'] = bot_token_var_name
 
-        with open(main_file_full_path, 'r') as f:
-            content = f.read()
-            if re.search(BOT_TOKEN_REGEX, content, re.IGNORECASE):
-                await update.message.reply_text(f"👍 Great! It seems your script might already handle the bot token. I will try to run it now assuming you've set the environment variable `{bot_token_var_name}` or will provide it via environment.\nIf it doesn't work, you might need to provide the token manually.", parse_mode=telegram.ParseMode.MARKDOWN)
-                process_id = await run_script(update.message.from_user.id, script_name, script_path, main_file_name, bot_token_env_name=bot_token_var_name) # Await the async function
-                if process_id:
-                    await update.message.reply_text(f"🚀 Bot `{script_name}` *started successfully*! (Process ID: `{process_id}`)", parse_mode=telegram.ParseMode.MARKDOWN)
-                else:
-                    await update.message.reply_text(f"❌ Failed to start bot `{script_name}`. Check server logs for errors.", parse_mode=telegram.ParseMode.MARKDOWN)
-                return ConversationHandler.END
+        if has_token:
+            await update.message.reply_text(f"👍 Great! It seems your script might already handle the bot token. I will try to run it now assuming you've set the environment variable `{bot_token_var_name}` or will provide it via environment.\nIf it doesn't work, you might need to provide the token manually.", parse_mode=ParseMode.MARKDOWN)
+            process_id = await launch_script(update.message.from_user.id, script_name, script_path, main_file_name, bot_token_env_name=bot_token_var_name, python_executable=python_executable) # Await the async function
+            if process_id:
+                await update.message.reply_text(f"🚀 Bot `{script_name}` *started successfully*! (Process ID: `{process_id}`)", parse_mode=ParseMode.MARKDOWN)
             else:
-                keyboard = [
-                    [InlineKeyboardButton("Yes, I'll provide it", callback_data='needs_token_yes')],
-                    [InlineKeyboardButton("No, it's handled differently", callback_data='needs_token_no')],
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await update.message.reply_text("❓ Does your script require a *Telegram Bot Token* as an environment variable?", reply_markup=reply_markup, parse_mode=telegram.ParseMode.MARKDOWN)
-                return CHECK_BOT_TOKEN
+                await update.message.reply_text(f"❌ Failed to start bot `{script_name}`. Check server logs for errors.", parse_mode=ParseMode.MARKDOWN)
+            return ConversationHandler.END
+        else:
+            keyboard = [
+                [InlineKeyboardButton("Yes, I'll provide it", callback_data='needs_token_yes')],
+                [InlineKeyboardButton("No, it's handled differently", callback_data='needs_token_no')],
+            ]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            await update.message.reply_text("❓ Does your script require a *Telegram Bot Token* as an environment variable?", reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
+            return CHECK_BOT_TOKEN
 
     except Exception as e:
         print(f"Error processing zip file or running script: {e}")
-        await update.message.reply_text("❌ Sorry, there was an error processing your script. Please try again.", parse_mode=telegram.ParseMode.MARKDOWN)
-        shutil.rmtree(script_path, ignore_errors=True)
+        await update.message.reply_text("❌ Sorry, there was an error processing your script. Please try again.", parse_mode=ParseMode.MARKDOWN)
+        await run_in_deploy_pool(remove_path, script_path)
         return ConversationHandler.END
 
 async def new_script_check_bot_token(update: Update, context: CallbackContext):
@@ -236,7 +2324,7 @@ async def new_script_check_bot_token(update: Update, context: CallbackContext):
     answer = query.data
 
     if answer == 'needs_token_yes':
-        await query.edit_message_text("👍 Okay, please send me your *Bot Token*. I will set it as an environment variable for your script.", parse_mode=telegram.ParseMode.MARKDOWN)
+        await query.edit_message_text("👍 Okay, please send me your *Bot Token*. I will set it as an environment variable for your script.", parse_mode=ParseMode.MARKDOWN)
         return GET_BOT_TOKEN
     elif answer == 'needs_token_no':
         user = query.from_user
@@ -245,12 +2333,12 @@ async def new_script_check_bot_token(update: Update, context: CallbackContext):
         script_path = os.path.join(SCRIPTS_DIR, script_name)
         bot_token_var_name = context.user_data.get('bot_token_var_name', "BOT_TOKEN")
 
-        await query.edit_message_text(f"👍 Okay, I will try to run your script *without* a bot token provided by me. Make sure your script handles token in other ways (e.g., config file, already set environment variable).\nRunning script assuming environment variable name will be `{bot_token_var_name}` (if used in script)", parse_mode=telegram.ParseMode.MARKDOWN)
-        process_id = await run_script(user.id, script_name, script_path, main_file_name, bot_token_env_name=bot_token_var_name) # Await the async function
+        await query.edit_message_text(f"👍 Okay, I will try to run your script *without* a bot token provided by me. Make sure your script handles token in other ways (e.g., config file, already set environment variable).\nRunning script assuming environment variable name will be `{bot_token_var_name}` (if used in script)", parse_mode=ParseMode.MARKDOWN)
+        process_id = await launch_script(user.id, script_name, script_path, main_file_name, bot_token_env_name=bot_token_var_name, python_executable=context.user_data.get('python_executable', DEFAULT_PYTHON)) # Await the async function
         if process_id:
-            await query.message.reply_text(f"🚀 Bot `{script_name}` *started successfully*! (Process ID: `{process_id}`)", parse_mode=telegram.ParseMode.MARKDOWN)
+            await query.message.reply_text(f"🚀 Bot `{script_name}` *started successfully*! (Process ID: `{process_id}`)", parse_mode=ParseMode.MARKDOWN)
         else:
-            await query.message.reply_text(f"❌ Failed to start bot `{script_name}`. Check server logs for errors.", parse_mode=telegram.ParseMode.MARKDOWN)
+            await query.message.reply_text(f"❌ Failed to start bot `{script_name}`. Check server logs for errors.", parse_mode=ParseMode.MARKDOWN)
         return ConversationHandler.END
     else:
         keyboard = [
@@ -258,7 +2346,7 @@ async def new_script_check_bot_token(update: Update, context: CallbackContext):
             [InlineKeyboardButton("No, it's handled differently", callback_data='needs_token_no')],
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text("❓ Please choose an option: Does your script require a *Bot Token*?", reply_markup=reply_markup, parse_mode=telegram.ParseMode.MARKDOWN)
+        await query.edit_message_text("❓ Please choose an option: Does your script require a *Bot Token*?", reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
         return CHECK_BOT_TOKEN
 
 async def new_script_get_bot_token(update: Update, context: CallbackContext):
@@ -270,61 +2358,69 @@ async def new_script_get_bot_token(update: Update, context: CallbackContext):
     script_path = os.path.join(SCRIPTS_DIR, script_name)
     bot_token_var_name = context.user_data.get('bot_token_var_name', "BOT_TOKEN")
 
-    process_id = await run_script(user.id, script_name, script_path, main_file_name, bot_token=bot_token, bot_token_env_name=bot_token_var_name) # Await the async function
+    process_id = await launch_script(user.id, script_name, script_path, main_file_name, bot_token=bot_token, bot_token_env_name=bot_token_var_name, python_executable=context.user_data.get('python_executable', DEFAULT_PYTHON)) # Await the async function
     if process_id:
-        await update.message.reply_text(f"🚀 Bot `{script_name}` *started successfully* with Bot Token set as environment variable `{bot_token_var_name}`! (Process ID: `{process_id}`)", parse_mode=telegram.ParseMode.MARKDOWN)
+        await update.message.reply_text(f"🚀 Bot `{script_name}` *started successfully* with Bot Token set as environment variable `{bot_token_var_name}`! (Process ID: `{process_id}`)", parse_mode=ParseMode.MARKDOWN)
     else:
-        await update.message.reply_text(f"❌ Failed to start bot `{script_name}`. Check server logs for errors. Make sure the Bot Token is correct.", parse_mode=telegram.ParseMode.MARKDOWN)
+        await update.message.reply_text(f"❌ Failed to start bot `{script_name}`. Check server logs for errors. Make sure the Bot Token is correct.", parse_mode=ParseMode.MARKDOWN)
     return ConversationHandler.END
 
 async def new_script_cancel(update: Update, context: CallbackContext):
     """Cancels the /new command conversation."""
     if update.message:
-        await update.message.reply_text("❌ Bot script upload *cancelled*.", parse_mode=telegram.ParseMode.MARKDOWN)
+        await update.message.reply_text("❌ Bot script upload *cancelled*.", parse_mode=ParseMode.MARKDOWN)
     elif update.callback_query:
         query = update.callback_query
         await query.answer()
-        await query.edit_message_text("❌ Bot script upload *cancelled*.", parse_mode=telegram.ParseMode.MARKDOWN)
+        await query.edit_message_text("❌ Bot script upload *cancelled*.", parse_mode=ParseMode.MARKDOWN)
 
+    job = context.user_data.pop('deploy_job', None)
+    if job:
+        cancel_deploy_job(job)
     temp_zip_path = context.user_data.get('temp_zip_path')
-    if temp_zip_path and os.path.exists(temp_zip_path):
-        os.remove(temp_zip_path)
+    if temp_zip_path:
+        await run_in_deploy_pool(remove_path, temp_zip_path)
     return ConversationHandler.END
 
 # --- /all command ---
 async def all_bots_command(update: Update, context: CallbackContext):
     """Lists all bots hosted by the user with inline buttons to remove."""
     user_id = update.effective_user.id
+    if WORKER_AGENTS and user_scripts.get(user_id):
+        await agent_statuses()
     if user_id in user_scripts:
         scripts = user_scripts[user_id]
         if scripts:
             keyboard = []
             bot_list_text = "*Your hosted bots:*\n"
             for name, data in scripts.items():
-                bot_list_text += f"- `{name}` (Process ID: `{data.get('process', 'N/A')}`)\n"
+                if data.get('mode') == 'remote':
+                    bot_list_text += f"- `{name}` ({data.get('state', 'unknown')} on `{data.get('node')}`, Process ID: `{data.get('remote_pid', 'N/A')}`, restarts: {data.get('restarts', 0)})\n"
+                else:
+                    bot_list_text += f"- `{name}` ({data.get('state', 'unknown')}, Process ID: `{data.get('process', 'N/A')}`, restarts: {data.get('restarts', 0)})\n"
                 keyboard.append([InlineKeyboardButton(f"Remove {name}", callback_data=f'remove_bot:{name}')])
 
             reply_markup = InlineKeyboardMarkup(keyboard)
             if update.message:
-                await update.message.reply_text(bot_list_text, reply_markup=reply_markup, parse_mode=telegram.ParseMode.MARKDOWN)
+                await update.message.reply_text(bot_list_text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
             elif update.callback_query:
                 query = update.callback_query
                 await query.answer()
-                await query.edit_message_text(bot_list_text, reply_markup=reply_markup, parse_mode=telegram.ParseMode.MARKDOWN)
+                await query.edit_message_text(bot_list_text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
         else:
             if update.message:
-                await update.message.reply_text("You have *no bots hosted* currently.", parse_mode=telegram.ParseMode.MARKDOWN)
+                await update.message.reply_text("You have *no bots hosted* currently.", parse_mode=ParseMode.MARKDOWN)
             elif update.callback_query:
                 query = update.callback_query
                 await query.answer()
-                await query.edit_message_text("You have *no bots hosted* currently.", parse_mode=telegram.ParseMode.MARKDOWN)
+                await query.edit_message_text("You have *no bots hosted* currently.", parse_mode=ParseMode.MARKDOWN)
     else:
         if update.message:
-            await update.message.reply_text("You have *no bots hosted* currently.", parse_mode=telegram.ParseMode.MARKDOWN)
+            await update.message.reply_text("You have *no bots hosted* currently.", parse_mode=ParseMode.MARKDOWN)
         elif update.callback_query:
             query = update.callback_query
             await query.answer()
-            await query.edit_message_text("You have *no bots hosted* currently.", parse_mode=telegram.ParseMode.MARKDOWN)
+            await query.edit_message_text("You have *no bots hosted* currently.", parse_mode=ParseMode.MARKDOWN)
 
 # --- /remove command callback ---
 async def remove_bot_command_callback(update: Update, context: CallbackContext):
@@ -334,57 +2430,375 @@ async def remove_bot_command_callback(update: Update, context: CallbackContext):
     user_id = query.from_user.id
     script_name_to_remove = query.data.split(':')[1]
 
+    script_path_to_remove = user_scripts.get(user_id, {}).get(script_name_to_remove, {}).get('path')
     if await stop_script(user_id, script_name_to_remove): # Await the async function
-        script_path_to_remove = user_scripts[user_id].get(script_name_to_remove, {}).get('path')
         if script_path_to_remove:
-            shutil.rmtree(script_path_to_remove, ignore_errors=True)
-        await query.edit_message_text(f"✅ Bot `{script_name_to_remove}` *stopped and removed*.", parse_mode=telegram.ParseMode.MARKDOWN)
+            await run_in_deploy_pool(remove_path, script_path_to_remove)
+        await run_in_log_pool(discard_bot_logs, script_name_to_remove)
+        await run_in_deploy_pool(remove_path, os.path.join(REVISIONS_DIR, script_name_to_remove))
+        await query.edit_message_text(f"✅ Bot `{script_name_to_remove}` *stopped and removed*.", parse_mode=ParseMode.MARKDOWN)
     else:
-        await query.edit_message_text(f"❌ Could not find or stop bot `{script_name_to_remove}`.", parse_mode=telegram.ParseMode.MARKDOWN)
+        await query.edit_message_text(f"❌ Could not find or stop bot `{script_name_to_remove}`.", parse_mode=ParseMode.MARKDOWN)
 
 async def remove_help_command(update: Update, context: CallbackContext):
     """Help message for remove command."""
     query = update.callback_query
     await query.answer()
-    await query.edit_message_text("To remove a bot, first use the `/all` command to list your hosted bots. Then, use the 'Remove' button associated with the bot you want to stop and remove. ", parse_mode=telegram.ParseMode.MARKDOWN)
+    await query.edit_message_text("To remove a bot, first use the `/all` command to list your hosted bots. Then, use the 'Remove' button associated with the bot you want to stop and remove. ", parse_mode=ParseMode.MARKDOWN)
+
+# --- /logs command ---
+def _format_log_text(script_name, lines):
+    text = "\n".join(lines) or "(no output yet)"
+    return f"Last {len(lines)} lines of {script_name}:\n\n" + text[-3800:]
+
+async def _follow_logs(message, bot):
+    """Keeps editing message with the newest log lines for LOG_FOLLOW_SECONDS."""
+    script_name = bot["script_name"]
+    deadline = time.monotonic() + LOG_FOLLOW_SECONDS
+    last_text = message.text
+    while time.monotonic() < deadline:
+        await asyncio.sleep(LOG_FOLLOW_INTERVAL)
+        text = _format_log_text(script_name, await bot_log_lines(bot, LOGS_DEFAULT_LINES))
+        if text != last_text:
+            try:
+                await message.edit_text(text)
+                last_text = text
+            except Exception as e:
+                print(f"Error following logs of {script_name}: {e}")
+                return
+
+async def logs_command(update: Update, context: CallbackContext):
+    """Shows the last lines of a bot's output: /logs <bot> [lines|follow]."""
+    user_id = update.effective_user.id
+    if not context.args:
+        await update.message.reply_text("Usage: `/logs <bot> [lines|follow]`", parse_mode=ParseMode.MARKDOWN)
+        return
+    script_name = context.args[0]
+    if script_name not in user_scripts.get(user_id, {}):
+        await update.message.reply_text(f"❌ You have no bot named `{script_name}`.", parse_mode=ParseMode.MARKDOWN)
+        return
+
+    option = context.args[1] if len(context.args) > 1 else ""
+    lines = LOGS_DEFAULT_LINES
+    if option.isdigit():
+        lines = max(1, min(int(option), LOGS_MAX_LINES))
+    bot = user_scripts[user_id][script_name]
+    message = await update.message.reply_text(_format_log_text(script_name, await bot_log_lines(bot, lines)))
+    if option == "follow":
+        task = asyncio.create_task(_follow_logs(message, bot))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+# --- /stats command ---
+def _format_bot_stats(script_name, bot):
+    if bot.get("mode") == "remote":
+        remote = bot.get("remote_stats") or {"cpu": 0.0, "rss": 0}
+        return (f"- `{script_name}` ({bot.get('state', 'unknown')} on `{bot.get('node')}`): "
+                f"CPU {remote['cpu']:.1f}%, RSS {remote['rss'] / 1024 ** 2:.1f} MB")
+    summary = summarize_stats(script_name)
+    if summary is None:
+        return f"- `{script_name}` ({bot.get('state', 'unknown')}): no samples yet"
+    latest = summary["latest"]
+    text = (f"- `{script_name}` ({bot.get('state', 'unknown')}): CPU {latest['cpu']:.1f}% "
+            f"(avg {summary['cpu_avg']:.1f}%, max {summary['cpu_max']:.1f}%), "
+            f"RSS {latest['rss'] / 1024 ** 2:.1f} MB (max {summary['rss_max'] / 1024 ** 2:.1f} MB), "
+            f"PSS {latest['pss'] / 1024 ** 2:.1f} MB, private {latest['private'] / 1024 ** 2:.1f} MB, "
+            f"FDs {latest['fds']}, I/O {latest['read_bytes'] / 1024 ** 2:.1f}/{latest['write_bytes'] / 1024 ** 2:.1f} MB r/w")
+    if summary["throttled"]:
+        text += ", throttled"
+    if bot.get("stop_reason"):
+        text += f", stopped: {bot['stop_reason']}"
+    if bot.get("last_wake_seconds") is not None:
+        text += f", last wake {bot['last_wake_seconds']:.2f}s"
+    return text
+
+async def stats_command(update: Update, context: CallbackContext):
+    """Shows resource usage of the user's bots; admins can use /stats all for the whole host."""
+    user_id = update.effective_user.id
+    if WORKER_AGENTS:
+        await agent_statuses()
+    if context.args and context.args[0] == "all":
+        if user_id not in ADMIN_USER_IDS:
+            await update.message.reply_text("❌ Only admins can see host-wide stats.")
+            return
+        bots = [(name, bot) for scripts in user_scripts.values() for name, bot in scripts.items()]
+        latest = {name: summary["latest"] for name, _ in bots if (summary := summarize_stats(name))}
+        bots.sort(key=lambda item: latest[item[0]]["rss"] if item[0] in latest else 0, reverse=True)
+        total_rss = sum(point["rss"] for point in latest.values())
+        total_pss = sum(point["pss"] for point in latest.values())
+        text = (f"*Host stats:* {len(bots)} bots, {total_rss / 1024 ** 2:.1f} MB RSS / "
+                f"{total_pss / 1024 ** 2:.1f} MB PSS in total\n*Top by memory:*\n")
+        text += "\n".join(_format_bot_stats(name, bot) for name, bot in bots[:10])
+    else:
+        scripts = user_scripts.get(user_id, {})
+        if not scripts:
+            await update.message.reply_text("You have *no bots hosted* currently.", parse_mode=ParseMode.MARKDOWN)
+            return
+        text = "*Your bots:*\n" + "\n".join(_format_bot_stats(name, bot) for name, bot in scripts.items())
+    await update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN)
+
+# --- /workers and /drain commands ---
+async def workers_command(update: Update, context: CallbackContext):
+    """Admin view of every worker agent: headroom, load and the bots placed on it."""
+    if update.effective_user.id not in ADMIN_USER_IDS:
+        await update.message.reply_text("❌ Only admins can see worker agents.")
+        return
+    if not WORKER_AGENTS:
+        await update.message.reply_text("No worker agents are configured; bots run on this host.")
+        return
+    statuses = await agent_statuses()
+    text = "*Worker agents:*\n"
+    for address, status in statuses.items():
+        agent = _agent(address)
+        if status is None:
+            text += f"- `{address}`: unreachable ({agent['failures']} failed checks)\n"
+            continue
+        rss = sum(entry["rss"] for entry in status["bots"])
+        text += (f"- `{address}` ({status['node']}){' draining' if agent['draining'] else ''}: "
+                 f"{len(status['bots'])} bots, {rss / 1024 ** 2:.1f} MB RSS, "
+                 f"{status['mem_available'] / 1024 ** 2:.0f}/{status['mem_total'] / 1024 ** 2:.0f} MB free, "
+                 f"load {status['load1']:.2f} on {status['cpus']} CPUs\n")
+    await update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN)
+
+async def drain_command(update: Update, context: CallbackContext):
+    """Moves all bots off a worker agent and stops placing new ones there: /drain <address> [off]."""
+    if update.effective_user.id not in ADMIN_USER_IDS:
+        await update.message.reply_text("❌ Only admins can drain worker agents.")
+        return
+    if not context.args or context.args[0] not in WORKER_AGENTS:
+        await update.message.reply_text("Usage: `/drain <address> [off]`. Use /workers to see the agents.", parse_mode=ParseMode.MARKDOWN)
+        return
+    address = context.args[0]
+    if len(context.args) > 1 and context.args[1] == "off":
+        _agent(address)["draining"] = False
+        await update.message.reply_text(f"✅ `{address}` accepts new bots again.", parse_mode=ParseMode.MARKDOWN)
+        return
+    _agent(address)["draining"] = True
+    status_message = await update.message.reply_text(f"⏳ Draining `{address}`...", parse_mode=ParseMode.MARKDOWN)
+    moved, failed = await evacuate_worker(address)
+    text = f"✅ Drained `{address}`: {moved} bots moved."
+    if failed:
+        text += f" {failed} bots did not fit elsewhere and are still running there."
+    await status_message.edit_text(text, parse_mode=ParseMode.MARKDOWN)
+
+# --- /update command conversation ---
+UPDATE_ZIP = 4
+
+async def update_start(update: Update, context: CallbackContext):
+    """Starts /update <bot> [overlap] by asking for the new zip file."""
+    user_id = update.effective_user.id
+    if not context.args or context.args[0] not in user_scripts.get(user_id, {}):
+        await update.message.reply_text("Usage: `/update <bot> [overlap]`. Use /all to see your bots.", parse_mode=ParseMode.MARKDOWN)
+        return ConversationHandler.END
+    context.user_data['update_script_name'] = context.args[0]
+    context.user_data['update_overlap'] = len(context.args) > 1 and context.args[1] == "overlap"
+    await update.message.reply_text(f"Send me the new *zip file* for `{context.args[0]}`. Only changed files will be replaced.", parse_mode=ParseMode.MARKDOWN)
+    return UPDATE_ZIP
+
+async def update_zip_file(update: Update, context: CallbackContext):
+    """Applies the uploaded zip as an incremental update and restarts the bot."""
+    zip_file = update.message.document
+    if zip_file.mime_type != 'application/zip':
+        await update.message.reply_text("⚠️ Please send a *valid zip file*.", parse_mode=ParseMode.MARKDOWN)
+        return UPDATE_ZIP
+    if zip_file.file_size and zip_file.file_size > MAX_UPLOAD_BYTES:
+        await update.message.reply_text(f"⚠️ Zip file is too large. The limit is *{MAX_UPLOAD_BYTES // 1024 ** 2} MB*.", parse_mode=ParseMode.MARKDOWN)
+        return UPDATE_ZIP
+
+    # Kept in locals, not user_data: a new /update or /new may start while this one is still running.
+    user_id = update.effective_user.id
+    script_name = context.user_data.get('update_script_name')
+    overlap = context.user_data.get('update_overlap')
+    bot = _bot_record(user_id, script_name)
+    if bot is None:
+        await update.message.reply_text(f"❌ Bot `{script_name}` no longer exists.", parse_mode=ParseMode.MARKDOWN)
+        return ConversationHandler.END
+
+    fd, temp_zip_path = tempfile.mkstemp(suffix=".zip")
+    os.close(fd)
+    job = None
+    try:
+        with deploy_timer("download"):
+            new_file = await context.bot.get_file(zip_file.file_id)
+            await new_file.download_to_drive(temp_zip_path)
+
+        status_message = await update.message.reply_text("⏳ Your update is queued...")
+        job = submit_deploy_job(user_id, script_name, lambda: prepare_update(bot, temp_zip_path, status_message))
+        context.user_data['update_job'] = job
+        try:
+            changed, added, python_executable = await wait_for_deploy_job(job, status_message)
+        except (ArchiveRejected, zipfile.BadZipFile) as e:
+            await update.message.reply_text(f"❌ Your zip file was rejected: {e}")
+            return ConversationHandler.END
+        except FileNotFoundError:
+            await update.message.reply_text(f"❌ Error: Main file `{bot['main_file']}` not found in the zip file. The bot was not changed.", parse_mode=ParseMode.MARKDOWN)
+            return ConversationHandler.END
+        except asyncio.CancelledError:
+            if not job["future"].cancelled():
+                raise
+            return ConversationHandler.END
+
+        if not changed and not added:
+            await update.message.reply_text(f"✅ No changes found, `{script_name}` keeps running.", parse_mode=ParseMode.MARKDOWN)
+            return ConversationHandler.END
+        async with deploy_stage("launch"):
+            with deploy_timer("launch"):
+                process_id = await restart_script(bot, python_executable, overlap=overlap)
+        if process_id:
+            await update.message.reply_text(f"🚀 Bot `{script_name}` *updated* ({len(changed)} changed, {len(added)} new files) and restarted! (Process ID: `{process_id}`)\nUse `/rollback {script_name}` to undo.", parse_mode=ParseMode.MARKDOWN)
+        else:
+            await update.message.reply_text(f"❌ Bot `{script_name}` was updated but failed to start. Use `/rollback {script_name}` to undo.", parse_mode=ParseMode.MARKDOWN)
+    except Exception as e:
+        print(f"Error updating {script_name}: {e}")
+        await update.message.reply_text("❌ Sorry, there was an error updating your bot. Please try again.", parse_mode=ParseMode.MARKDOWN)
+    finally:
+        if job is not None and context.user_data.get('update_job') is job:
+            del context.user_data['update_job']
+        await run_in_deploy_pool(remove_path, temp_zip_path)
+    return ConversationHandler.END
+
+async def update_cancel(update: Update, context: CallbackContext):
+    """Cancels the /update conversation; an update that is already being applied runs to completion."""
+    job = context.user_data.get('update_job')
+    if job and job["state"] == "running":
+        text = "⚠️ Your update is already being applied and can no longer be cancelled."
+    else:
+        text = "❌ Bot update *cancelled*. Your bot was not changed."
+        context.user_data.pop('update_job', None)
+        if job:
+            cancel_deploy_job(job)
+    if update.message:
+        await update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN)
+    elif update.callback_query:
+        query = update.callback_query
+        await query.answer()
+        await query.edit_message_text(text, parse_mode=ParseMode.MARKDOWN)
+    # If update_zip_file is still running (WAITING), some PTB versions end the conversation
+    # right away, so a new /update or /new can start next to it. That is safe because
+    # update_zip_file keeps its zip path and job to itself.
+    return ConversationHandler.END
+
+async def rollback_command(update: Update, context: CallbackContext):
+    """Undoes the last /update of a bot and restarts it: /rollback <bot>."""
+    user_id = update.effective_user.id
+    bot = _bot_record(user_id, context.args[0]) if context.args else None
+    if bot is None:
+        await update.message.reply_text("Usage: `/rollback <bot>`. Use /all to see your bots.", parse_mode=ParseMode.MARKDOWN)
+        return
+    manifest = await run_in_deploy_pool(rollback_files, bot["path"], os.path.join(REVISIONS_DIR, bot["script_name"]))
+    if manifest is None:
+        await update.message.reply_text(f"❌ There is no previous revision of `{bot['script_name']}`.", parse_mode=ParseMode.MARKDOWN)
+        return
+    python_executable = manifest["python"] if os.path.exists(manifest["python"]) or manifest["python"] == DEFAULT_PYTHON else None
+    if python_executable is None:
+        python_executable = await install_requirements(bot["path"]) or DEFAULT_PYTHON
+    process_id = await restart_script(bot, python_executable)
+    if process_id:
+        await update.message.reply_text(f"⏪ Bot `{bot['script_name']}` *rolled back* and restarted! (Process ID: `{process_id}`)", parse_mode=ParseMode.MARKDOWN)
+    else:
+        await update.message.reply_text(f"❌ Bot `{bot['script_name']}` was rolled back but failed to start.", parse_mode=ParseMode.MARKDOWN)
 
 async def error(update: Update, context: CallbackContext):
     """Log Errors caused by Updates."""
     print(f'Update {update} caused error {context.error}')
     print(f'Context error: {context.error}') # Print context error as well
+    increment("handler_errors_total")
+    log_event("handler_error", error=repr(context.error))
 
-async def main():
-    """Start the bot."""
-    if not os.path.exists(SCRIPTS_DIR):
-        os.makedirs(SCRIPTS_DIR)
+async def on_startup(application):
+    """Restores registered bots and starts the host's background tasks."""
+    start_deploy_workers()
+    await recover_bots()
+    for coroutine in (log_tailer(), resource_sampler(), monitor_event_loop_lag()):
+        background_tasks.add(asyncio.create_task(coroutine))
+    if HIBERNATE_ENABLED:
+        background_tasks.add(asyncio.create_task(hibernation_manager()))
+    if WORKER_AGENTS:
+        background_tasks.add(asyncio.create_task(agent_monitor()))
+    metrics_server = await start_metrics_server()
+    if metrics_server is not None:
+        background_tasks.add(asyncio.create_task(metrics_server.serve_forever()))
 
-    application = Application.builder().token(BOT_TOKEN).build()
+async def on_shutdown(application):
+    """Stops helper processes; standalone bots keep running and are re-adopted on the next start."""
+    await stop_zygotes()
+    # Tenants are cheap to restart and are relaunched from the registry on the next start.
+    await stop_tenant_workers()
 
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("all", all_bots_command))
-    application.add_handler(CommandHandler("remove", remove_help_command))
+def build_application(token=BOT_TOKEN, base_url=TELEGRAM_API_BASE, base_file_url=TELEGRAM_FILE_BASE):
+    """Builds the host Application with all handlers registered."""
+    application = (
+        Application.builder()
+        .token(token)
+        .base_url(base_url)
+        .base_file_url(base_file_url)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+
+    # Every callback is wrapped so its latency is recorded per handler (and so per conversation state).
+    # Updates are processed in order, as ConversationHandler requires; handlers that wait on deploys,
+    # stops or agents run with block=False so one user's slow deploy does not stall everyone else.
+    application.add_handler(CommandHandler("start", instrument_handler(start)))
+    application.add_handler(CommandHandler("help", instrument_handler(help_command)))
+    application.add_handler(CommandHandler("all", instrument_handler(all_bots_command), block=False))
+    application.add_handler(CommandHandler("remove", instrument_handler(remove_help_command)))
+    application.add_handler(CommandHandler("logs", instrument_handler(logs_command), block=False))
+    application.add_handler(CommandHandler("stats", instrument_handler(stats_command), block=False))
+    application.add_handler(CommandHandler("workers", instrument_handler(workers_command), block=False))
+    application.add_handler(CommandHandler("drain", instrument_handler(drain_command), block=False))
 
     conv_handler = ConversationHandler(
-        entry_points=[CommandHandler('new', new_script_start), CallbackQueryHandler(new_script_start, pattern='^new$')],
+        entry_points=[CommandHandler('new', instrument_handler(new_script_start)), CallbackQueryHandler(instrument_handler(new_script_start), pattern='^new$')],
         states={
-            NEW_SCRIPT_ZIP: [MessageHandler(filters.Document.ALL, new_script_zip_file)],
-            GET_MAIN_FILE_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, new_script_main_file_name)],
-            CHECK_BOT_TOKEN: [CallbackQueryHandler(new_script_check_bot_token)],
-            GET_BOT_TOKEN: [MessageHandler(filters.TEXT & ~filters.COMMAND, new_script_get_bot_token)],
+            NEW_SCRIPT_ZIP: [MessageHandler(filters.Document.ALL, instrument_handler(new_script_zip_file))],
+            GET_MAIN_FILE_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, instrument_handler(new_script_main_file_name))],
+            CHECK_BOT_TOKEN: [CallbackQueryHandler(instrument_handler(new_script_check_bot_token))],
+            GET_BOT_TOKEN: [MessageHandler(filters.TEXT & ~filters.COMMAND, instrument_handler(new_script_get_bot_token))],
+            # Updates that arrive while a non-blocking step is still running; only cancelling is allowed.
+            ConversationHandler.WAITING: [CallbackQueryHandler(instrument_handler(new_script_cancel), pattern='^cancel$', block=True), CommandHandler('cancel', instrument_handler(new_script_cancel), block=True)],
         },
-        fallbacks=[CallbackQueryHandler(new_script_cancel, pattern='^cancel$'), CommandHandler('cancel', new_script_cancel)],
+        fallbacks=[CallbackQueryHandler(instrument_handler(new_script_cancel), pattern='^cancel$'), CommandHandler('cancel', instrument_handler(new_script_cancel))],
+        block=False,
     )
     application.add_handler(conv_handler)
 
-    application.add_handler(CallbackQueryHandler(help_command, pattern='^help$'))
-    application.add_handler(CallbackQueryHandler(all_bots_command, pattern='^all$'))
-    application.add_handler(CallbackQueryHandler(remove_bot_command_callback, pattern='^remove_bot:'))
-    application.add_handler(CallbackQueryHandler(remove_help_command, pattern='^remove_help$'))
+    update_handler = ConversationHandler(
+        entry_points=[CommandHandler('update', instrument_handler(update_start))],
+        states={
+            UPDATE_ZIP: [MessageHandler(filters.Document.ALL, instrument_handler(update_zip_file))],
+            ConversationHandler.WAITING: [CallbackQueryHandler(instrument_handler(update_cancel), pattern='^cancel$', block=True), CommandHandler('cancel', instrument_handler(update_cancel), block=True)],
+        },
+        fallbacks=[CallbackQueryHandler(instrument_handler(update_cancel), pattern='^cancel$'), CommandHandler('cancel', instrument_handler(update_cancel))],
+        block=False,
+    )
+    application.add_handler(update_handler)
+    application.add_handler(CommandHandler("rollback", instrument_handler(rollback_command), block=False))
+
+    application.add_handler(CallbackQueryHandler(instrument_handler(help_command), pattern='^help$'))
+    application.add_handler(CallbackQueryHandler(instrument_handler(all_bots_command), pattern='^all$', block=False))
+    application.add_handler(CallbackQueryHandler(instrument_handler(remove_bot_command_callback), pattern='^remove_bot:', block=False))
+    application.add_handler(CallbackQueryHandler(instrument_handler(remove_help_command), pattern='^remove_help$'))
 
     application.add_error_handler(error)
+    return application
 
-    await application.run_polling()
+def main():
+    """Start the bot."""
+    if not os.path.exists(SCRIPTS_DIR):
+        os.makedirs(SCRIPTS_DIR)
+    os.makedirs(ENVS_DIR, exist_ok=True)
+    os.makedirs(LOGS_DIR, exist_ok=True)
+    open_registry()
+    if WORKER_AGENTS:
+        load_agent_secret()
+
+    application = build_application()
+    if WEBHOOK_ENABLED:
+        asyncio.run(serve_webhook(application))
+    else:
+        application.run_polling()  # Manages its own event loop
 
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -0,0 +1,182 @@
+"""In-process multi-tenant worker for small hosted bots.
+
+Started by newhost.py as ``python3 tenant_worker.py <socket_path>``. Many tenant
+bots run here as separate telegram.ext.Application instances on one asyncio
+loop and share one HTTP connection pool. A tenant is any bot whose main file
+defines ``setup_handlers(application)``, which adds its handlers to the
+Application it is given.
+
+The host talks to the worker over a Unix socket, one JSON line per request:
+
+    {"op": "start", "name": ..., "path": ..., "main_file": ..., "token": ..., "log_file": ...,
+     "base_url": ..., "base_file_url": ...}
+    {"op": "stop", "name": ...}
+    {"op": "status"}
+
+Every reply is a JSON line with "ok" and either a result or an "error".
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import traceback
+import importlib.util
+from telegram.ext import Application
+from telegram.request import HTTPXRequest
+
+TENANT_FACTORY = "setup_handlers"
+TENANT_TASK_BUDGET = 8  # Updates processed concurrently per tenant
+SHARED_POOL_SIZE = 256  # Connections for regular API calls, shared by all tenants
+UPDATES_POOL_SIZE = 4096  # Long-poll connections, one per tenant
+TENANT_LOG_MAX_BYTES = 1024 ** 2
+
+tenants = {}  # name -> {"application", "log_file", "errors", "started_at"}
+
+class SharedRequest(HTTPXRequest):
+    """HTTPXRequest that outlives the Applications using it.
+
+    Application.shutdown() shuts down its request objects; the shared pool is only
+    closed when the worker exits.
+    """
+
+    async def shutdown(self):
+        pass
+
+    async def close(self):
+        await super().shutdown()
+
+def tenant_log(name, line):
+    """Appends a line to the tenant's log file, rotating it once it grows past TENANT_LOG_MAX_BYTES."""
+    tenant = tenants.get(name)
+    if tenant is None or not tenant["log_file"]:
+        print(f"[{name}] {line}", file=sys.stderr)
+        return
+    path = tenant["log_file"]
+    try:
+        if os.path.exists(path) and os.path.getsize(path) > TENANT_LOG_MAX_BYTES:
+            os.replace(path, path + ".1")
+        with open(path, 'a') as f:
+            f.write(f"[tenant {time.strftime('%Y-%m-%d %H:%M:%S')}] {line}\n")
+    except OSError as e:
+        print(f"[{name}] could not write log: {e}", file=sys.stderr)
+
+def load_factory(name, path, main_file):
+    """Imports the tenant's main file under a private module name and returns its handler factory."""
+    spec = importlib.util.spec_from_file_location(f"tenant_{name}", os.path.join(path, main_file))
+    module = importlib.util.module_from_spec(spec)
+    sys.path.insert(0, path)
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(path)
+    factory = getattr(module, TENANT_FACTORY, None)
+    if not callable(factory):
+        raise ValueError(f"{main_file} does not define {TENANT_FACTORY}(application)")
+    return factory
+
+async def start_tenant(request, shared, shared_updates):
+    name = request["name"]
+    if name in tenants:
+        raise ValueError(f"tenant {name} is already running")
+    factory = load_factory(name, request["path"], request["main_file"])
+    application = (
+        Application.builder()
+        .token(request["token"])
+        .base_url(request["base_url"])
+        .base_file_url(request["base_file_url"])
+        .request(shared)
+        .get_updates_request(shared_updates)
+        .concurrent_updates(TENANT_TASK_BUDGET)
+        .build()
+    )
+    tenants[name] = {"application": application, "log_file": request.get("log_file"),
+                     "errors": 0, "started_at": time.time()}
+
+    async def on_error(update, context):
+        # Errors stay inside the tenant: they are logged and counted, never propagated.
+        tenants[name]["errors"] += 1
+        tenant_log(name, "".join(traceback.format_exception(context.error)).rstrip())
+
+    try:
+        factory(application)
+        application.add_error_handler(on_error)
+        await application.initialize()
+        await application.updater.start_polling()
+        await application.start()
+    except BaseException:
+        tenants.pop(name, None)
+        raise
+    tenant_log(name, "started")
+
+async def stop_tenant(name):
+    tenant = tenants.get(name)
+    if tenant is None:
+        raise ValueError(f"tenant {name} is not running")
+    application = tenant["application"]
+    try:
+        if application.updater.running:
+            await application.updater.stop()
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+    finally:
+        tenant_log(name, "stopped")
+        tenants.pop(name, None)
+
+def status():
+    return {
+        "pid": os.getpid(),
+        "tenants": {name: {"errors": tenant["errors"], "started_at": tenant["started_at"]}
+                    for name, tenant in tenants.items()},
+    }
+
+async def handle_connection(reader, writer, shared, shared_updates):
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                request = json.loads(line)
+                if request["op"] == "start":
+                    await start_tenant(request, shared, shared_updates)
+                    reply = {"ok": True}
+                elif request["op"] == "stop":
+                    await stop_tenant(request["name"])
+                    reply = {"ok": True}
+                elif request["op"] == "status":
+                    reply = {"ok": True, "result": status()}
+                else:
+                    reply = {"ok": False, "error": f"unknown op {request['op']}"}
+            except Exception as e:
+                reply = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+            writer.write(json.dumps(reply).encode() + b"\n")
+            await writer.drain()
+    finally:
+        writer.close()
+
+async def main(socket_path):
+    shared = SharedRequest(connection_pool_size=SHARED_POOL_SIZE)
+    shared_updates = SharedRequest(connection_pool_size=UPDATES_POOL_SIZE)
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = await asyncio.start_unix_server(
+        lambda reader, writer: handle_connection(reader, writer, shared, shared_updates),
+        path=socket_path
+    )
+    os.chmod(socket_path, 0o600)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        for name in list(tenants):
+            try:
+                await stop_tenant(name)
+            except Exception as e:
+                print(f"Error stopping tenant {name}: {e}", file=sys.stderr)
+        await shared.close()
+        await shared_updates.close()
+
+if __name__ == '__main__':
+    asyncio.run(main(sys.argv[1]))
@@ -0,0 +1,111 @@
+import asyncio
+import zipfile
+import contextlib
+from collections import deque
+
+import pytest
+
+import newhost
+
+
+def job(user_id, name):
+    return {"user_id": user_id, "name": name, "state": "queued"}
+
+
+@pytest.fixture
+def queues(monkeypatch):
+    queues = newhost.OrderedDict()
+    monkeypatch.setattr(newhost, "deploy_queues", queues)
+    return queues
+
+
+def test_next_deploy_job_is_round_robin(queues):
+    a1, a2, a3, b1, c1 = job(1, "a1"), job(1, "a2"), job(1, "a3"), job(2, "b1"), job(3, "c1")
+    queues[1] = deque([a1, a2, a3])
+    queues[2] = deque([b1])
+    queues[3] = deque([c1])
+    order = [newhost._next_deploy_job()["name"] for _ in range(5)]
+    assert order == ["a1", "b1", "c1", "a2", "a3"]
+    assert not queues
+
+
+def test_deploy_queue_position_matches_dispatch_order(queues):
+    jobs = [job(1, "a1"), job(1, "a2"), job(1, "a3"), job(2, "b1"), job(2, "b2"), job(3, "c1")]
+    for entry in jobs:
+        queues.setdefault(entry["user_id"], deque()).append(entry)
+    positions = {entry["name"]: newhost.deploy_queue_position(entry) for entry in jobs}
+    dispatched = [newhost._next_deploy_job()["name"] for _ in jobs]
+    assert sorted(positions, key=positions.get) == dispatched
+    assert sorted(positions.values()) == list(range(1, len(jobs) + 1))
+
+
+def test_deploy_queue_position_of_finished_job_is_zero(queues):
+    entry = job(1, "a1")
+    queues[1] = deque([entry])
+    newhost._next_deploy_job()
+    entry["state"] = "running"
+    assert newhost.deploy_queue_position(entry) == 0
+
+
+def run_with_worker(monkeypatch, scenario):
+    """Runs scenario(worker) on a fresh loop with one deploy worker."""
+    async def main():
+        monkeypatch.setattr(newhost, "deploy_queue_ready", asyncio.Condition())
+        worker = asyncio.create_task(newhost._deploy_worker())
+        try:
+            return await scenario(worker)
+        finally:
+            worker.cancel()
+            await asyncio.wait([worker], timeout=1)
+    return asyncio.run(main())
+
+
+async def start_slow_job():
+    started = asyncio.Event()
+
+    async def slow():
+        started.set()
+        await asyncio.sleep(60)
+
+    job = newhost.submit_deploy_job(1, "slow", slow)
+    await started.wait()
+    return job
+
+
+def test_cancelled_job_does_not_stop_the_worker(queues, monkeypatch):
+    async def scenario(worker):
+        job = await start_slow_job()
+        newhost.cancel_deploy_job(job)
+        await asyncio.gather(job["future"], return_exceptions=True)
+        quick = newhost.submit_deploy_job(1, "quick", lambda: asyncio.sleep(0, "done"))
+        return job["future"].cancelled(), await quick["future"], worker.done()
+
+    assert run_with_worker(monkeypatch, scenario) == (True, "done", False)
+
+
+def test_cancelling_the_worker_is_not_swallowed(queues, monkeypatch):
+    async def scenario(worker):
+        job = await start_slow_job()
+        worker.cancel()
+        await asyncio.wait([worker], timeout=1)
+        return worker.cancelled(), job["task"].cancelled(), job["state"]
+
+    assert run_with_worker(monkeypatch, scenario) == (True, True, "cancelled")
+
+
+def test_failed_status_edit_does_not_fail_the_deploy(tmp_path, monkeypatch):
+    class FloodedMessage:
+        async def edit_text(self, text, **kwargs):
+            raise RuntimeError("Flood control exceeded")
+
+    @contextlib.asynccontextmanager
+    async def no_stage_limit(name):
+        yield
+
+    monkeypatch.setattr(newhost, "deploy_stage", no_stage_limit)
+    zip_path, script_path = tmp_path / "bot.zip", tmp_path / "bot"
+    with zipfile.ZipFile(zip_path, 'w') as archive:
+        archive.writestr("main.py", "print(1)")
+    python = asyncio.run(newhost.prepare_deploy(str(zip_path), str(script_path), "main.py", FloodedMessage()))
+    assert python == newhost.DEFAULT_PYTHON
+    assert (script_path / "main.py").exists() and not zip_path.exists()
@@ -0,0 +1,54 @@
+import os
+import zipfile
+
+import pytest
+
+import newhost
+
+
+def progress():
+    return {"files_done": 0, "files_total": 0, "bytes_done": 0}
+
+
+def make_zip(path, members, compression=zipfile.ZIP_DEFLATED):
+    with zipfile.ZipFile(path, 'w', compression) as archive:
+        for name, data in members.items():
+            archive.writestr(name, data)
+    return str(path)
+
+
+def test_extract_archive_writes_members_and_progress(tmp_path):
+    zip_path = make_zip(tmp_path / "bot.zip", {"main.py": "print(1)", "pkg/mod.py": "x = 1"})
+    dest = tmp_path / "out"
+    state = progress()
+    newhost.extract_archive(zip_path, str(dest), state)
+    assert (dest / "pkg" / "mod.py").read_text() == "x = 1"
+    assert state == {"files_done": 2, "files_total": 2, "bytes_done": len("print(1)") + len("x = 1")}
+
+
+def test_extract_archive_rejects_path_traversal(tmp_path):
+    zip_path = make_zip(tmp_path / "evil.zip", {"../escape.py": "boom"})
+    with pytest.raises(newhost.ArchiveRejected, match="unsafe path"):
+        newhost.extract_archive(zip_path, str(tmp_path / "out"), progress())
+    assert not os.path.exists(tmp_path / "escape.py")
+
+
+def test_extract_archive_rejects_too_many_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(newhost, "MAX_ARCHIVE_FILES", 2)
+    zip_path = make_zip(tmp_path / "many.zip", {f"{i}.py": "" for i in range(3)})
+    with pytest.raises(newhost.ArchiveRejected, match="more than 2 files"):
+        newhost.extract_archive(zip_path, str(tmp_path / "out"), progress())
+
+
+def test_extract_archive_rejects_oversized_archive(tmp_path, monkeypatch):
+    monkeypatch.setattr(newhost, "MAX_ARCHIVE_BYTES", 1024)
+    zip_path = make_zip(tmp_path / "big.zip", {"big.bin": b"x" * 2048}, zipfile.ZIP_STORED)
+    with pytest.raises(newhost.ArchiveRejected, match="expands to more than"):
+        newhost.extract_archive(zip_path, str(tmp_path / "out"), progress())
+
+
+def test_extract_archive_rejects_zip_bomb(tmp_path, monkeypatch):
+    monkeypatch.setattr(newhost, "EXTRACT_CHUNK_SIZE", 1024)
+    zip_path = make_zip(tmp_path / "bomb.zip", {"bomb.bin": b"\0" * 1024 ** 2})
+    with pytest.raises(newhost.ArchiveRejected, match="compression ratio"):
+        newhost.extract_archive(zip_path, str(tmp_path / "out"), progress())
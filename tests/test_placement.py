@@ -0,0 +1,40 @@
+import pytest
+
+import newhost
+
+MB = 1024 ** 2
+
+
+@pytest.fixture(autouse=True)
+def agents(monkeypatch):
+    monkeypatch.setattr(newhost, "worker_agents", {})
+
+
+def status(mem_available_mb, cpus=2, bots=()):
+    return {"mem_available": mem_available_mb * MB, "cpus": cpus, "bots": list(bots)}
+
+
+def test_pick_worker_prefers_most_memory_headroom():
+    statuses = {"a:1": status(1000), "b:1": status(2000), "c:1": None}
+    address, need_rss, need_cpu = newhost.pick_worker(statuses)
+    assert address == "b:1"
+    assert need_rss == newhost.BOT_DEFAULT_RSS_MB * MB
+    assert need_cpu == newhost.BOT_DEFAULT_CPU_PERCENT
+
+
+def test_pick_worker_skips_draining_excluded_and_full_agents():
+    statuses = {"a:1": status(2000), "b:1": status(1500), "c:1": status(1000), "d:1": status(200)}
+    newhost._agent("a:1")["draining"] = True
+    assert newhost.pick_worker(statuses, exclude=("b:1",))[0] == "c:1"
+    assert newhost.pick_worker({"d:1": status(200)})[0] is None
+
+
+def test_pick_worker_counts_reservations_and_cpu():
+    statuses = {"a:1": status(2000), "b:1": status(1500)}
+    newhost._agent("a:1")["reserved_rss"] = 1000 * MB
+    assert newhost.pick_worker(statuses)[0] == "b:1"
+
+    busy = [{"rss": 10 * MB, "cpu": 99.0}]
+    statuses = {"a:1": status(2000, cpus=1, bots=busy), "b:1": status(1000, cpus=1)}
+    newhost._agent("a:1")["reserved_rss"] = 0
+    assert newhost.pick_worker(statuses)[0] == "b:1"
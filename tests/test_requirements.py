@@ -0,0 +1,44 @@
+import pytest
+
+import newhost
+
+
+def hash_of(tmp_path, text):
+    path = tmp_path / "requirements.txt"
+    path.write_text(text)
+    return newhost.requirements_hash(str(path))
+
+
+def test_requirements_hash_ignores_comments_blank_lines_and_order(tmp_path):
+    first = hash_of(tmp_path, "requests==2.31.0\n\n# pinned\naiohttp>=3.9  # async\n")
+    second = hash_of(tmp_path, "aiohttp>=3.9\nrequests==2.31.0\n")
+    assert first == second and first is not None
+
+
+def test_requirements_hash_normalizes_project_names_only(tmp_path):
+    assert hash_of(tmp_path, "Python_Telegram.Bot==22.0\n") == hash_of(tmp_path, "python-telegram-bot == 22.0\n")
+    url = "pkg @ https://example.com/Pkg-1.0.tar.gz#sha256=ABC\n"
+    assert hash_of(tmp_path, url) != hash_of(tmp_path, url.replace("Pkg", "pkg"))
+    assert hash_of(tmp_path, url) != hash_of(tmp_path, url.replace("ABC", "abc"))
+
+
+@pytest.mark.parametrize("line", [
+    "-r base.txt", "-rbase.txt", "-c c.txt", "-cc.txt", "--requirement=base.txt", "--constraint c.txt",
+    "-e .", "-e.", "--editable=./lib", "-f ./wheels",
+    ".", "./pkg", "~/pkg", "vendor/pkg", "pkg.whl", "dist/pkg-1.0-py3-none-any.whl", "pkg-1.0.tar.gz",
+    "file:///srv/pkg", "pkg @ file:///srv/pkg",
+])
+def test_requirements_hash_is_none_for_local_files(tmp_path, line):
+    assert hash_of(tmp_path, f"requests\n{line}\n") is None
+
+
+@pytest.mark.parametrize("line", [
+    "requests[socks]>=2; python_version >= '3.8'",
+    "pkg @ https://example.com/pkg-1.0-py3-none-any.whl",
+    "https://example.com/pkg-1.0.tar.gz",
+    "-e git+https://github.com/org/pkg.git#egg=pkg",
+    "--find-links https://example.com/wheels",
+    "--index-url https://pypi.example.com/simple",
+])
+def test_requirements_hash_shares_remote_requirements(tmp_path, line):
+    assert hash_of(tmp_path, f"{line}\n") is not None
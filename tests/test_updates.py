@@ -0,0 +1,63 @@
+import os
+import json
+
+import newhost
+
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def read(path):
+    with open(path, 'r') as f:
+        return f.read()
+
+
+def make_trees(tmp_path):
+    script_path, staging_path = tmp_path / "bot", tmp_path / "staging"
+    write(script_path / "main.py", "print('v1')")
+    write(script_path / "lib" / "util.py", "same")
+    write(script_path / "data.db", "runtime data")
+    write(staging_path / "main.py", "print('v2')")
+    write(staging_path / "lib" / "util.py", "same")
+    write(staging_path / "lib" / "new.py", "added")
+    return str(staging_path), str(script_path)
+
+
+def test_diff_trees_reports_changed_and_added(tmp_path):
+    staging_path, script_path = make_trees(tmp_path)
+    changed, added = newhost.diff_trees(staging_path, script_path)
+    assert changed == ["main.py"]
+    assert added == [os.path.join("lib", "new.py")]
+
+
+def test_diff_trees_detects_same_size_change(tmp_path):
+    write(tmp_path / "a" / "f.txt", "abc")
+    write(tmp_path / "b" / "f.txt", "abd")
+    assert newhost.diff_trees(str(tmp_path / "a"), str(tmp_path / "b")) == (["f.txt"], [])
+
+
+def test_apply_update_then_rollback_restores_tree(tmp_path):
+    staging_path, script_path = make_trees(tmp_path)
+    revision_path = str(tmp_path / "revision")
+    changed, added = newhost.diff_trees(staging_path, script_path)
+
+    newhost.apply_update(staging_path, script_path, revision_path, changed, added, {"main_file": "main.py"})
+    assert read(os.path.join(script_path, "main.py")) == "print('v2')"
+    assert read(os.path.join(script_path, "lib", "new.py")) == "added"
+    assert read(os.path.join(script_path, "data.db")) == "runtime data"
+    with open(os.path.join(revision_path, "manifest.json"), 'r') as f:
+        manifest = json.load(f)
+    assert manifest["changed"] == changed and manifest["main_file"] == "main.py"
+
+    assert newhost.rollback_files(script_path, revision_path)["added"] == added
+    assert read(os.path.join(script_path, "main.py")) == "print('v1')"
+    assert not os.path.exists(os.path.join(script_path, "lib", "new.py"))
+    assert read(os.path.join(script_path, "data.db")) == "runtime data"
+    assert not os.path.exists(revision_path)
+
+
+def test_rollback_without_revision_returns_none(tmp_path):
+    assert newhost.rollback_files(str(tmp_path), str(tmp_path / "missing")) is None
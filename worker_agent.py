@@ -0,0 +1,204 @@
+"""Worker agent that runs hosted bots on behalf of a newhost.py scheduler.
+
+    python worker_agent.py --root /srv/agent1 --listen 0.0.0.0:7701 --secret-file /etc/newhost/agent_secret
+    python worker_agent.py --root /srv/agent2 --unix /run/agent2.sock --secret-file /etc/newhost/agent_secret
+
+The agent reuses newhost's supervisor, dependency cache, log capture, resource
+sampler and registry, all rooted in --root, so several agents can run on one
+machine. The scheduler talks to it with one JSON line per request, each
+carrying the shared secret:
+
+    {"op": "launch", "name", "user_id", "main_file", "archive" (base64 zip), "bot_token", "env_name"}
+    {"op": "stop", "name"}      stops the bot but keeps its files
+    {"op": "remove", "name"}    stops the bot and deletes its files and logs
+    {"op": "status"}            node headroom plus per-bot state, RSS and CPU
+    {"op": "logs", "name", "lines"}
+
+Every reply is a JSON line with "ok" and either a result or an "error".
+Bot tokens travel in these requests, so keep agents on a private network.
+The secret is read from a mode 0600 file rather than argv or the environment,
+where the hosted bots could see it, and is kept out of their environment.
+"""
+import os
+import sys
+import hmac
+import json
+import base64
+import socket
+import asyncio
+import argparse
+import tempfile
+
+import newhost
+
+MAX_REQUEST_BYTES = 256 * 1024 ** 2  # Base64 of the largest accepted upload, with room to spare
+INLINE_PARSE_BYTES = 64 * 1024  # Larger request lines (launches) are parsed in the deploy pool
+
+def node_status():
+    """Memory and CPU headroom of this machine plus the state of every bot on it."""
+    meminfo = {}
+    with open("/proc/meminfo", 'r') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            meminfo[key] = int(value.split()[0]) * 1024
+    bots = []
+    for scripts in newhost.user_scripts.values():
+        for name, bot in scripts.items():
+            summary = newhost.summarize_stats(name)
+            bots.append({
+                "name": name, "user_id": bot["user_id"], "state": bot.get("state"), "pid": bot.get("process"),
+                "restarts": bot.get("restarts", 0),
+                "rss": summary["latest"]["rss"] if summary else 0,
+                "cpu": summary["latest"]["cpu"] if summary else 0.0,
+            })
+    return {
+        "node": socket.gethostname(),
+        "pid": os.getpid(),
+        "cpus": os.cpu_count(),
+        "load1": os.getloadavg()[0],
+        "mem_total": meminfo.get("MemTotal", 0),
+        "mem_available": meminfo.get("MemAvailable", 0),
+        "bots": bots,
+    }
+
+def _find(name):
+    for user_id, scripts in newhost.user_scripts.items():
+        if name in scripts:
+            return user_id, scripts[name]
+    return None, None
+
+def _write_archive(archive):
+    """Decodes a base64 upload into a temporary zip file and returns its path."""
+    fd, zip_path = tempfile.mkstemp(suffix=".zip")
+    with os.fdopen(fd, 'wb') as f:
+        f.write(base64.b64decode(archive))
+    return zip_path
+
+def _authorized(request, secret):
+    return hmac.compare_digest(str(request.get("secret", "")).encode(), secret.encode())
+
+async def launch(request):
+    """Installs the archive as bot <name> and starts it, replacing a running instance of the same name."""
+    name = request["name"]
+    user_id, bot = _find(name)
+    if bot is not None:
+        await newhost.stop_script(user_id, name)
+    script_path = os.path.join(newhost.SCRIPTS_DIR, name)
+    zip_path = await newhost.run_in_deploy_pool(_write_archive, request.pop("archive"))
+    await newhost.run_in_deploy_pool(newhost.remove_path, script_path)
+    progress = {"files_done": 0, "files_total": 0, "bytes_done": 0}
+    try:
+        await newhost.run_in_deploy_pool(os.makedirs, script_path, 0o777, True)
+        await newhost.run_in_deploy_pool(newhost.extract_archive, zip_path, script_path, progress)
+    finally:
+        await newhost.run_in_deploy_pool(newhost.remove_path, zip_path)
+    if not os.path.exists(os.path.join(script_path, request["main_file"])):
+        raise FileNotFoundError(request["main_file"])
+    python_executable = await newhost.install_requirements(script_path) or newhost.DEFAULT_PYTHON
+    pid = await newhost.run_script(request["user_id"], name, script_path, request["main_file"],
+                                   bot_token=request.get("bot_token"),
+                                   bot_token_env_name=request.get("env_name", "BOT_TOKEN"),
+                                   python_executable=python_executable)
+    if pid is None:
+        raise RuntimeError(f"bot {name} failed to start")
+    return {"pid": pid}
+
+async def stop(request):
+    _, bot = _find(request["name"])
+    if bot is None:
+        raise KeyError(request["name"])
+    await newhost.terminate_bot(bot)
+    return None
+
+async def remove(request):
+    name = request["name"]
+    user_id, bot = _find(name)
+    if bot is not None:
+        script_path = bot["path"]
+        await newhost.stop_script(user_id, name)
+        await newhost.run_in_deploy_pool(newhost.remove_path, script_path)
+    await newhost.run_in_log_pool(newhost.discard_bot_logs, name)
+    return None
+
+async def logs(request):
+    return await newhost.recent_log_lines(request["name"], min(int(request.get("lines", 20)), newhost.LOG_RING_LINES))
+
+OPERATIONS = {"launch": launch, "stop": stop, "remove": remove, "logs": logs}
+
+async def handle_connection(reader, writer, secret):
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                if len(line) > INLINE_PARSE_BYTES:
+                    request = await newhost.run_in_deploy_pool(json.loads, line)
+                else:
+                    request = json.loads(line)
+                if not _authorized(request, secret):
+                    reply = {"ok": False, "error": "forbidden"}
+                elif request["op"] == "status":
+                    reply = {"ok": True, "result": node_status()}
+                elif request["op"] in OPERATIONS:
+                    reply = {"ok": True, "result": await OPERATIONS[request["op"]](request)}
+                else:
+                    reply = {"ok": False, "error": f"unknown op {request['op']}"}
+            except Exception as e:
+                reply = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+            writer.write(json.dumps(reply).encode() + b"\n")
+            await writer.drain()
+    except (ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+async def serve(args):
+    for path in (newhost.SCRIPTS_DIR, newhost.ENVS_DIR, newhost.LOGS_DIR):
+        os.makedirs(path, exist_ok=True)
+    newhost.open_registry()
+    newhost.start_deploy_workers()
+    await newhost.recover_bots()
+    for coroutine in (newhost.log_tailer(), newhost.resource_sampler(), newhost.monitor_event_loop_lag()):
+        newhost.background_tasks.add(asyncio.create_task(coroutine))
+    if newhost.HIBERNATE_ENABLED:
+        newhost.background_tasks.add(asyncio.create_task(newhost.hibernation_manager()))
+
+    handler = lambda reader, writer: handle_connection(reader, writer, args.secret)
+    if args.unix:
+        server = await asyncio.start_unix_server(handler, path=args.unix, limit=MAX_REQUEST_BYTES)
+    else:
+        host, _, port = args.listen.rpartition(':')
+        server = await asyncio.start_server(handler, host or "127.0.0.1", int(port), limit=MAX_REQUEST_BYTES)
+    print(f"Worker agent serving on {args.unix or args.listen} from {os.getcwd()}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await newhost.stop_zygotes()
+        await newhost.stop_tenant_workers()
+
+def main():
+    parser = argparse.ArgumentParser(description="Run hosted bots for a newhost.py scheduler.")
+    parser.add_argument("--root", default=".", help="directory for this agent's scripts, envs, logs and registry")
+    parser.add_argument("--listen", default="127.0.0.1:7701", help="host:port to listen on")
+    parser.add_argument("--unix", help="listen on this Unix socket instead of TCP")
+    parser.add_argument("--secret-file", default=os.environ.get("AGENT_SECRET_FILE"),
+                        help="mode 0600 file holding the shared secret (or $AGENT_SECRET_FILE)")
+    args = parser.parse_args()
+    if not args.secret_file:
+        sys.exit("A shared secret file is required (--secret-file or $AGENT_SECRET_FILE)")
+    try:
+        args.secret = newhost.read_secret_file(args.secret_file)
+    except (OSError, ValueError) as e:
+        sys.exit(f"Cannot read the shared secret: {e}")
+    if args.unix:
+        args.unix = os.path.abspath(args.unix)
+    os.makedirs(args.root, exist_ok=True)
+    os.chdir(args.root)
+    newhost.WORKER_AGENTS = []  # Bots run here, never forwarded to further agents
+    newhost.METRICS_PORT = 0  # The scheduler serves the metrics endpoint
+    asyncio.run(serve(args))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""Zygote launcher for hosted bots.
+
+Started by newhost.py as ``python zygote.py <socket_path> [module ...]`` with the
+interpreter of a dependency environment. It imports the given modules once, then
+forks a child for every launch request so bots start without paying interpreter
+and import time again and share the preloaded pages copy-on-write.
+
+Each request is one JSON line ({"cwd", "env", "main_file"}) sent over the Unix
+socket together with one file descriptor for the bot's stdout/stderr. The reply
+is a JSON line with the child's PID ({"pid": ...}) or an error. The connection
+then stays open: the zygote reaps the child and sends its exit status as a
+second line ({"pid": ..., "returncode": ...}), negative for a signal as in
+subprocess, before closing it.
+
+Only the standard library is used here so it runs under any environment.
+"""
+import os
+import sys
+import json
+import runpy
+import signal
+import socket
+import select
+import importlib
+import traceback
+
+MAX_REQUEST_BYTES = 1024 ** 2
+
+def preload(modules):
+    """Imports modules that exist in this environment, skipping the ones that don't."""
+    for name in modules:
+        try:
+            importlib.import_module(name)
+        except Exception as e:
+            print(f"Zygote could not preload {name}: {e}", file=sys.stderr)
+
+def run_bot(request, output_fd, inherited):
+    """Turns the freshly forked child into the bot process. Never returns.
+
+    inherited are the zygote's own sockets and pipes, which the bot must not keep open.
+    """
+    exit_code = 0
+    try:
+        os.setsid()
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        for resource in inherited:
+            if isinstance(resource, int):
+                os.close(resource)
+            else:
+                resource.close()
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.dup2(output_fd, 1)
+        os.dup2(output_fd, 2)
+        os.close(devnull)
+        os.close(output_fd)
+
+        cwd = request["cwd"]
+        os.chdir(cwd)
+        os.environ.clear()
+        os.environ.update(request["env"])
+        sys.argv = [request["main_file"]]
+        sys.path.insert(0, cwd)
+        runpy.run_path(request["main_file"], run_name="__main__")
+    except SystemExit as e:
+        if isinstance(e.code, int):
+            exit_code = e.code
+        elif e.code is not None:
+            print(e.code, file=sys.stderr)
+            exit_code = 1
+    except BaseException:
+        traceback.print_exc()
+        exit_code = 1
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(exit_code)
+
+def read_request(conn):
+    """Reads one newline-terminated JSON request and the descriptor sent with it."""
+    data, fds, _, _ = socket.recv_fds(conn, 65536, 1)
+    while not data.endswith(b"\n"):
+        if len(data) > MAX_REQUEST_BYTES:
+            raise ValueError("request too large")
+        chunk = conn.recv(65536)
+        if not chunk:
+            raise ValueError("connection closed mid-request")
+        data += chunk
+    if len(fds) != 1:
+        raise ValueError("expected exactly one output descriptor")
+    return json.loads(data), fds[0]
+
+def _send(conn, reply):
+    try:
+        conn.sendall(json.dumps(reply).encode() + b"\n")
+        return True
+    except OSError:
+        return False
+
+def reap_children(watchers):
+    """Collects every exited child and reports its status on the connection that launched it."""
+    while True:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if pid == 0:
+            return
+        conn = watchers.pop(pid, None)
+        if conn is not None:
+            _send(conn, {"pid": pid, "returncode": os.waitstatus_to_exitcode(status)})
+            conn.close()
+
+def launch(conn, server, watchers, wakeup):
+    """Forks a bot for the request on conn; conn then waits in watchers for the bot's exit."""
+    output_fd = None
+    try:
+        request, output_fd = read_request(conn)
+        pid = os.fork()
+        if pid == 0:
+            run_bot(request, output_fd, [conn, server, *watchers.values(), *wakeup])
+    except Exception as e:
+        _send(conn, {"error": str(e)})
+        conn.close()
+        return
+    finally:
+        if output_fd is not None:
+            os.close(output_fd)
+    if _send(conn, {"pid": pid}):
+        watchers[pid] = conn
+    else:
+        conn.close()
+
+def serve(socket_path):
+    # SIGCHLD only wakes the select() below; children are reaped in the main loop.
+    wakeup = os.pipe()
+    for fd in wakeup:
+        os.set_blocking(fd, False)
+    signal.set_wakeup_fd(wakeup[1])
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    os.chmod(socket_path, 0o600)
+    server.listen(64)
+    watchers = {}  # pid -> connection waiting for that child's exit status
+    while True:
+        readable, _, _ = select.select([server, wakeup[0]], [], [])
+        if wakeup[0] in readable:
+            while True:
+                try:
+                    if not os.read(wakeup[0], 4096):
+                        break
+                except BlockingIOError:
+                    break
+            reap_children(watchers)
+        if server in readable:
+            conn, _ = server.accept()
+            launch(conn, server, watchers, wakeup)
+
+if __name__ == '__main__':
+    preload(sys.argv[2:])
+    serve(sys.argv[1])